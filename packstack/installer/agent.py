@@ -0,0 +1,94 @@
+"""
+Remote side of the packstack agent.
+
+This file is not imported by the installer, its source is piped to a
+python interpreter on each remote host once per run. Requests and
+responses are then exchanged with the controller over stdin/stdout as
+frames made of a decimal length line followed by that many bytes of
+JSON. It has to run on any python from 2.6 onwards and may only use
+the standard library.
+"""
+import codecs
+import json
+import os
+import select
+import subprocess
+import sys
+import threading
+
+def readFrame(stream):
+    header = stream.readline()
+    if not header:
+        return None
+    data = stream.read(int(header))
+    return json.loads(data.decode("utf-8"))
+
+def writeFrame(stream, message):
+    data = json.dumps(message).encode("utf-8")
+    stream.write(("%d\n" % len(data)).encode("ascii"))
+    stream.write(data)
+    stream.flush()
+
+def _decode(data):
+    if isinstance(data, bytes):
+        return data.decode("utf-8", "replace")
+    return data
+
+def run(request, send):
+    """
+    Run a script with bash -x, its output is sent back to the controller
+    as it is produced in frames carrying a stream name and the data
+    """
+    proc = subprocess.Popen(["bash", "-x"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, close_fds=True)
+
+    # bash reads the script as it goes, feed it from a thread so a script
+    # producing a lot of output early can't deadlock against us
+    def feed():
+        try:
+            proc.stdin.write(request["script"].encode("utf-8"))
+        finally:
+            proc.stdin.close()
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+
+    streams = {proc.stdout.fileno(): "stdout", proc.stderr.fileno(): "stderr"}
+    decoders = {}
+    for fd in streams:
+        decoders[fd] = codecs.getincrementaldecoder("utf-8")("replace")
+    while streams:
+        for fd in select.select(list(streams), [], [])[0]:
+            data = os.read(fd, 65536)
+            text = decoders[fd].decode(data, not data)
+            if text:
+                send({"stream": streams[fd], "data": text})
+            if not data:
+                del streams[fd]
+    feeder.join()
+    return {"rc": proc.wait()}
+
+def ping(request, send):
+    return {"rc": 0, "pid": os.getpid()}
+
+OPERATIONS = {"run": run, "ping": ping}
+
+def main():
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    while True:
+        request = readFrame(stdin)
+        if request is None or request.get("op") == "exit":
+            break
+
+        def send(message):
+            message["id"] = request.get("id")
+            writeFrame(stdout, message)
+
+        try:
+            response = OPERATIONS[request["op"]](request, send)
+        except Exception:
+            response = {"rc": 255, "error": str(sys.exc_info()[1])}
+        send(response)
+
+if __name__ == "__main__":
+    main()
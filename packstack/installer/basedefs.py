@@ -10,9 +10,14 @@ FILE_YUM_VERSION_LOCK="/etc/yum/pluginconf.d/versionlock.list"
 VAR_DIR = os.path.join("/var/tmp", str(uuid.uuid4()))
 DIR_LOG = VAR_DIR
 PUPPET_MANIFEST_DIR = os.path.join(VAR_DIR, "manifests")
+# where puppet module trees are kept on the remote hosts, by content hash
+REMOTE_MODULE_CACHE_DIR = "/var/cache/packstack/modules"
 
 FILE_INSTALLER_LOG = "setup.log"
 
+# state kept on this machine from one run to the next
+DIR_STATE = os.path.join(os.path.expanduser("~"), ".packstack")
+
 DIR_PROJECT_DIR = os.environ.get('INSTALLER_PROJECT_DIR', os.path.join(os.path.split(sys.argv[0])[0], 'sample-project'))
 DIR_PLUGINS = os.path.join(DIR_PROJECT_DIR, "plugins")
 DIR_MODULES = os.path.join(DIR_PROJECT_DIR, "modules")
@@ -14,6 +14,16 @@ import datetime
 import types
 import time
 import tempfile
+import threading
+import pipes
+import Queue
+import json
+import select
+import errno
+import collections
+import resource
+import transports
+import hashlib
 
 def getColoredText (text, color):
     ''' gets text string and color
@@ -290,46 +300,1067 @@ def installed(rpm):
 def returnYes(controller):
     return "yes"
 
+# how commands reach the hosts, set from CONFIG_TRANSPORT by setTransport()
+transport = transports.SshTransport()
+
+def setTransport(name):
+    global transport
+    transport.closeAll()
+    transport = transports.getTransport(name)
+    logging.debug("Using the %s transport" % transport.name)
+
+class OutputCapture(object):
+    """
+    Collects the output of one remote script as it is produced. Output is
+    appended to a per host log file under the log directory and only the
+    last taillines lines of each stream are kept in memory for error
+    reporting. callbacks are called as callback(host, stream, line) for
+    every line, a stream's last line is passed on as it is when the
+    output ends without a newline.
+    """
+    taillines = 100
+    # longest partial line we hold on to before treating it as a line
+    maxlinelen = 65536
+
+    def __init__(self, host, callbacks=[]):
+        self.host = host
+        self.callbacks = callbacks
+        self.tails = {"stdout": collections.deque(maxlen=self.taillines),
+                      "stderr": collections.deque(maxlen=self.taillines)}
+        self.partial = {"stdout": "", "stderr": ""}
+        self.logfile = os.path.join(basedefs.DIR_LOG, "hosts", "%s.log" % (host or "localhost"))
+        try:
+            os.makedirs(os.path.dirname(self.logfile))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.fp = open(self.logfile, "a")
+
+    def writeHeader(self, script):
+        self.fp.write("# ============ %s ============\n%s\n# ============ output ============\n" %
+                      (getCurrentDateTime(), script))
+
+    def _addLine(self, stream, line):
+        if line.endswith("\n"):
+            self.fp.write("%s: %s" % (stream, line))
+        else:
+            self.fp.write("%s: %s\n" % (stream, line))
+        self.tails[stream].append(line)
+        for callback in self.callbacks:
+            callback(self.host, stream, line)
+
+    def feed(self, stream, data):
+        lines = (self.partial[stream] + data).splitlines(True)
+        self.partial[stream] = ""
+        if lines and not lines[-1].endswith("\n") and len(lines[-1]) < self.maxlinelen:
+            self.partial[stream] = lines.pop()
+        for line in lines:
+            self._addLine(stream, line)
+
+    def getTail(self, stream):
+        return "".join(self.tails[stream])
+
+    def close(self):
+        for stream in self.partial:
+            if self.partial[stream]:
+                self._addLine(stream, self.partial[stream])
+                self.partial[stream] = ""
+        self.fp.close()
+
+# largest write to a pipe that is guaranteed not to block once it polls writable
+PIPE_CHUNK = 4096
+
+AGENT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent.py")
+# reads the agent source from the start of stdin and runs it, the rest of
+# stdin is then left for the agent's request frames
+AGENT_BOOTSTRAP = "exec $(command -v python || command -v python3) -c %s" % pipes.quote(
+    "import sys; stdin = getattr(sys.stdin, 'buffer', sys.stdin); exec(stdin.read(int(stdin.readline())))")
+
+def _toStr(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+class RemoteAgent(object):
+    """
+    Controller side of the packstack agent (see agent.py) running on a
+    remote host. The agent is started over a single ssh session the first
+    time it is needed and every request after that is one framed message
+    round trip on the session's stdin/stdout. Only one request can be in
+    flight per agent, whoever sends one must hold lock until its response
+    has been read.
+    """
+    def __init__(self, host):
+        self.host = host
+        self.proc = None
+        self.lastid = 0
+        self.buffer = ""
+        self.lock = threading.Lock()
+
+    def _start(self):
+        logging.debug("Starting packstack agent on %s" % self.host)
+        with open(AGENT_SOURCE) as fp:
+            source = fp.read()
+        with open(os.devnull, "w") as devnull:
+            self.proc = subprocess.Popen(transport.getArgs(self.host, AGENT_BOOTSTRAP),
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=devnull, close_fds=True)
+        self.buffer = ""
+        self.proc.stdin.write("%d\n%s" % (len(source), source))
+        self.send({"op": "ping"})
+        self.readResponse()
+
+    def _lost(self):
+        self.close()
+        raise Exception("Lost connection to the packstack agent on %s" % self.host)
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def send(self, request):
+        if not self.proc:
+            self._start()
+        self.lastid += 1
+        request["id"] = self.lastid
+        data = json.dumps(request)
+        try:
+            self.proc.stdin.write("%d\n%s" % (len(data), data))
+            self.proc.stdin.flush()
+        except IOError:
+            self._lost()
+
+    def readFrames(self):
+        """
+        Read whatever the agent has sent so far (a single read, which will
+        block if there is nothing) and return the complete frames in it
+        """
+        data = os.read(self.fileno(), 65536)
+        if not data:
+            self._lost()
+        self.buffer += data
+        frames = []
+        while "\n" in self.buffer:
+            header, rest = self.buffer.split("\n", 1)
+            if len(rest) < int(header):
+                break
+            frames.append(json.loads(rest[:int(header)]))
+            self.buffer = rest[int(header):]
+        return frames
+
+    def handleFrame(self, frame, onoutput=None):
+        """
+        Returns the frame if it's the final response to the current request,
+        output frames are passed to onoutput(stream, data) and return None
+        """
+        if "stream" in frame:
+            if onoutput:
+                onoutput(_toStr(frame["stream"]), _toStr(frame["data"]))
+            return None
+        if "error" in frame:
+            raise Exception("packstack agent on %s failed: %s" % (self.host, frame["error"]))
+        return frame
+
+    def readResponse(self, onoutput=None):
+        while True:
+            for frame in self.readFrames():
+                response = self.handleFrame(frame, onoutput)
+                if response:
+                    return response
+
+    def call(self, op, onoutput=None, **kwargs):
+        """
+        Send a single request to the agent and return its response dict,
+        onoutput(stream, data) is called for any output sent before it
+        """
+        with self.lock:
+            request = {"op": op}
+            request.update(kwargs)
+            self.send(request)
+            return self.readResponse(onoutput)
+
+    def close(self, kill=False):
+        if not self.proc:
+            return
+        if kill:
+            self.proc.kill()
+        else:
+            try:
+                self.proc.stdin.write("%d\n%s" % (len('{"op": "exit"}'), '{"op": "exit"}'))
+                self.proc.stdin.close()
+            except IOError:
+                pass
+        self.proc.wait()
+        self.proc = None
+
+class AgentPool(object):
+    """
+    Holds the RemoteAgent of every host used during the run. If an agent
+    can't be started on a host (e.g. no python) get() returns None for it
+    and callers should fall back to plain ssh sessions.
+    """
+    # set from CONFIG_USE_AGENT
+    enabled = False
+
+    def __init__(self):
+        self.agents = {}
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        if not AgentPool.enabled or not host:
+            return None
+        with self.lock:
+            if host not in self.agents:
+                self.agents[host] = RemoteAgent(host)
+            agent = self.agents[host]
+        if agent is None or agent.proc:
+            return agent
+        try:
+            agent.call("ping")
+        except Exception:
+            logging.warning("Can't use the packstack agent on %s, falling back to ssh" % host)
+            logging.debug(traceback.format_exc())
+            agent.close()
+            with self.lock:
+                self.agents[host] = None
+            return None
+        return agent
+
+    def closeAll(self):
+        with self.lock:
+            for agent in self.agents.values():
+                if agent:
+                    agent.close()
+            self.agents = {}
+agents = AgentPool()
+
+def getTreeHash(path, exclude=()):
+    """
+    Returns a sha1 of the names, modes and contents of everything under
+    path, following symlinks and skipping anything named in exclude
+    """
+    digest = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+        dirnames[:] = sorted([name for name in dirnames if name not in exclude])
+        for name in dirnames:
+            digest.update("d %s\n" % os.path.relpath(os.path.join(dirpath, name), path))
+        for name in sorted(filenames):
+            if name in exclude:
+                continue
+            filepath = os.path.join(dirpath, name)
+            filedigest = hashlib.sha1()
+            with open(filepath, "rb") as fp:
+                for chunk in iter(lambda: fp.read(65536), ""):
+                    filedigest.update(chunk)
+            digest.update("f %s %o %s\n" % (os.path.relpath(filepath, path), os.stat(filepath).st_mode & 07777,
+                                             filedigest.hexdigest()))
+    return digest.hexdigest()
+
+class ScriptTimeoutException(Exception):
+    """
+    Raised for a remote script that didn't finish before its deadline
+    """
+    def __init__(self, host, timeout):
+        Exception.__init__(self, output_messages.ERR_SCRIPT_TIMEOUT % (host or "localhost", timeout))
+        self.host = host
+
+# hosts that missed a deadline during this run, later HostPool runs skip them
+stragglers = set()
+
+# per thread deadline of the host a HostPool.run() worker is busy with
+_hostdeadline = threading.local()
+
+class ScriptSession(object):
+    """
+    A ScriptRunner script executing on its host, either as a bash process
+    (over ssh for remote hosts) or as a request to the host's agent. The
+    session is driven by an ExecutionLoop, which calls start(), then
+    handle() whenever one of the session's fds is ready and finally
+    finish() once no fds are left.
+    """
+    def __init__(self, runner, logerrors=True, timeout=None):
+        self.runner = runner
+        self.ip = runner.ip
+        self.logerrors = logerrors
+        self.timeout = timeout
+        self.starttime = None
+        self.deadline = None
+        self.script = "\n".join(runner.script)
+        if runner.errexit:
+            self.script = "function t(){ exit $? ; } \n trap t ERR \n" + self.script
+        self.capture = None
+        self.proc = None
+        self.agent = None
+        self.fds = {}
+        self.stdindata = ""
+        self.returncode = None
+        self.error = None
+
+    def start(self):
+        """
+        Start the script, returns False if it can't be started yet because
+        the host's agent is busy with another request
+        """
+        agent = agents.get(self.ip)
+        if agent:
+            if not agent.lock.acquire(False):
+                return False
+            self.agent = agent
+
+        logging.debug("# ============ ssh : %r =========="%self.ip)
+        logging.debug("\n".join(self.runner.script))
+        self.capture = OutputCapture(self.ip, self.runner.callbacks)
+        self.capture.writeHeader(self.script)
+
+        self.starttime = time.time()
+        if self.timeout:
+            self.deadline = self.starttime + self.timeout
+        hostdeadline = getattr(_hostdeadline, "deadline", None)
+        if hostdeadline and (not self.deadline or hostdeadline < self.deadline):
+            self.deadline = hostdeadline
+
+        if agent:
+            try:
+                agent.send({"op": "run", "script": self.script})
+            except Exception as e:
+                self._fail(e)
+                return True
+            self.fds[agent.fileno()] = "agent"
+            return True
+
+        _PIPE = subprocess.PIPE  # pylint: disable=E1101
+        if self.ip:
+            cmd = transport.getArgs(self.ip, "bash -x")
+        else:
+            cmd = ["bash", "-x"]
+        self.proc = subprocess.Popen(cmd, stdin=_PIPE, stdout=_PIPE, stderr=_PIPE,
+                                     close_fds=True, shell=False)
+        self.fds[self.proc.stdout.fileno()] = "stdout"
+        self.fds[self.proc.stderr.fileno()] = "stderr"
+        self.fds[self.proc.stdin.fileno()] = "stdin"
+        self.stdindata = self.script
+        return True
+
+    def _fail(self, error):
+        self.error = error
+        self.fds = {}
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+
+    def getPollEvents(self, fd):
+        if self.fds[fd] == "stdin":
+            return select.POLLOUT
+        return select.POLLIN
+
+    def handle(self, fd):
+        """
+        Do whatever I/O fd is ready for, returns True once the session is
+        done with fd
+        """
+        kind = self.fds[fd]
+        if kind == "stdin":
+            try:
+                self.stdindata = self.stdindata[os.write(fd, self.stdindata[:PIPE_CHUNK]):]
+            except OSError as e:
+                # the other end stopped reading, nothing more to send
+                if e.errno != errno.EPIPE:
+                    raise
+                self.stdindata = ""
+            if self.stdindata:
+                return False
+            self.proc.stdin.close()
+        elif kind == "agent":
+            try:
+                for frame in self.agent.readFrames():
+                    response = self.agent.handleFrame(frame, self.capture.feed)
+                    if response:
+                        self.returncode = response["rc"]
+                        break
+                else:
+                    return False
+            except Exception as e:
+                self.error = e
+        else:
+            output = os.read(fd, 65536)
+            if output:
+                self.capture.feed(kind, output)
+                return False
+        del self.fds[fd]
+        return True
+
+    def isFinished(self):
+        return not self.fds
+
+    def expire(self):
+        """
+        Kill the script because its deadline passed
+        """
+        logging.warning("Killing remote script on %s, it didn't finish in time" % (self.ip or "localhost"))
+        timeout = int(round(self.deadline - self.starttime))
+        if self.agent:
+            # the agent is stuck in the request, start a new one next time
+            self.agent.close(kill=True)
+        self._fail(ScriptTimeoutException(self.ip, timeout))
+
+    def finish(self):
+        if self.agent:
+            self.agent.lock.release()
+        if self.proc:
+            self.returncode = self.proc.wait()
+        if not self.capture:
+            return
+        self.capture.close()
+        logging.debug("============ output logged to %s ==========" % self.capture.logfile)
+        if isinstance(self.error, ScriptTimeoutException):
+            log = logging.debug
+            if self.logerrors:
+                log = logging.error
+            log("============= STDERR before timeout (last %d lines) ==========" % self.capture.taillines)
+            log(self.capture.getTail("stderr"))
+        elif self.returncode and not self.error:
+            log = logging.debug
+            if self.logerrors:
+                log = logging.error
+            log("============= STDERR (last %d lines) ==========" % self.capture.taillines)
+            log(self.capture.getTail("stderr"))
+            self.error = Exception(self.runner.errmsg or "Error running remote script")
+
+    def check(self):
+        """
+        Raise the session's error if the script failed
+        """
+        if self.error:
+            raise self.error
+
+def _raiseFileLimit(wanted):
+    # every session needs a few pipes and a log file open at once
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted and soft != resource.RLIM_INFINITY:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+class ExecutionLoop(object):
+    """
+    Drives any number of ScriptSessions from the calling thread using
+    poll() on their non-blocking pipes, so thousands of hosts can be
+    handled at once without a thread (or much memory) per host. At most
+    limit sessions are running at a time, the rest wait in a queue.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.queued = collections.deque()
+        self.running = []
+        self.registered = {}
+        self.fdmap = {}
+        self.poller = select.poll()
+        if limit:
+            _raiseFileLimit(limit * 5 + 64)
+
+    def add(self, session):
+        self.queued.append(session)
+
+    def isEmpty(self):
+        return not self.queued and not self.running
+
+    def _startQueued(self):
+        deferred = []
+        while self.queued and (not self.limit or len(self.running) < self.limit):
+            session = self.queued.popleft()
+            try:
+                started = session.start()
+            except Exception as e:
+                logging.debug(traceback.format_exc())
+                session._fail(e)
+                started = True
+            if not started:
+                deferred.append(session)
+                continue
+            self.running.append(session)
+            self.registered[session] = list(session.fds)
+            for fd in session.fds:
+                self.fdmap[fd] = session
+                self.poller.register(fd, session.getPollEvents(fd))
+        self.queued.extendleft(reversed(deferred))
+
+    def _reap(self):
+        finished = [session for session in self.running if session.isFinished()]
+        for session in finished:
+            self.running.remove(session)
+            del self.registered[session]
+            session.finish()
+        return finished
+
+    def _unregister(self, session, fd):
+        # a session's pipes may already be closed and their fd numbers
+        # reused by a session started since, leave those alone
+        if self.fdmap.get(fd) is session:
+            self.poller.unregister(fd)
+            del self.fdmap[fd]
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for sessions to make
+        progress, returns the list of sessions that finished
+        """
+        self._startQueued()
+        finished = self._reap()
+        if finished or self.isEmpty():
+            return finished
+
+        # sessions waiting on a busy agent only get a chance to start
+        # after another session finishes, so don't sleep forever
+        if self.queued and (not self.limit or len(self.running) < self.limit):
+            if timeout is None or timeout > 0.1:
+                timeout = 0.1
+        # nor past the earliest deadline
+        deadlines = [session.deadline for session in self.running if session.deadline]
+        if deadlines:
+            untildeadline = max(0, min(deadlines) - time.time())
+            if timeout is None or untildeadline < timeout:
+                timeout = untildeadline
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        try:
+            events = self.poller.poll(timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            session = self.fdmap.get(fd)
+            if not session:
+                # unregistered by an earlier event in this batch
+                continue
+            try:
+                done = session.handle(fd)
+            except Exception as e:
+                logging.debug(traceback.format_exc())
+                session._fail(e)
+                done = True
+            if not done:
+                continue
+            closed = [fd]
+            if session.isFinished():
+                closed = self.registered[session]
+            for fd in closed:
+                self._unregister(session, fd)
+        now = time.time()
+        for session in self.running:
+            if session.deadline and session.deadline <= now and not session.isFinished():
+                session.expire()
+                for fd in self.registered[session]:
+                    self._unregister(session, fd)
+        finished = self._reap()
+        self._startQueued()
+        return finished
+
+    def run(self):
+        """
+        Run until every session has finished, returns all the sessions
+        """
+        finished = []
+        while not self.isEmpty():
+            finished.extend(self.poll())
+        return finished
+
+class HostPoolResult(object):
+    """
+    Per host outcome of a HostPool run, results holds the return value
+    of every host that succeeded and errors the exception of every host
+    that failed
+    """
+    def __init__(self, hosts):
+        self.hosts = list(hosts)
+        self.results = {}
+        self.errors = {}
+        self.skipped = []
+
+    def getSucceededHosts(self):
+        return [host for host in self.hosts if host in self.results]
+
+    def getFailedHosts(self):
+        return [host for host in self.hosts if host in self.errors
+                and not isinstance(self.errors[host], ScriptTimeoutException)]
+
+    def getStragglers(self):
+        return [host for host in self.hosts if isinstance(self.errors.get(host), ScriptTimeoutException)]
+
+    def _addError(self, host, error):
+        self.errors[host] = error
+        if isinstance(error, ScriptTimeoutException):
+            stragglers.add(host)
+
+    def raiseOnError(self):
+        """
+        Raise an exception if any host failed. Hosts that missed their
+        deadline aren't failures, they are only logged and the run carries
+        on without them
+        """
+        for host in self.getStragglers():
+            logging.warning("%s: %s" % (host, self.errors[host]))
+        failed = self.getFailedHosts()
+        if failed:
+            for host in failed:
+                logging.error("%s: %s" % (host, self.errors[host]))
+            raise Exception(output_messages.ERR_HOSTS_FAILED % ", ".join(failed))
+
+# threads used to open connections to hosts ahead of HostPool.runScripts
+CONNECT_THREADS = 32
+
+def _connect(host):
+    if not agents.get(host):
+        transport.connect(host)
+
+class HostPool(object):
+    """
+    Runs something for each host of a list concurrently, with at most
+    parallelism hosts in flight at once. run() calls a function with the
+    host as its first argument in worker threads, runScripts() executes a
+    ScriptRunner per host from a single thread, e.g.
+
+        def install(host):
+            server = ScriptRunner(host)
+            server.append("rpm -q puppet || yum install -y puppet")
+            return server
+        HostPool(hosts).runScripts(install).raiseOnError()
+    """
+    # default concurrency, set from CONFIG_PARALLELISM
+    parallelism = 10
+    # default seconds each host gets, set from CONFIG_HOST_TIMEOUT
+    deadline = 0
+
+    def __init__(self, hosts, parallelism=None, deadline=None):
+        self.hosts = hosts
+        if parallelism is None:
+            parallelism = HostPool.parallelism
+        self.parallelism = max(1, int(parallelism))
+        if deadline is None:
+            deadline = HostPool.deadline
+        self.deadline = deadline
+
+    def _getHosts(self, result):
+        hosts = []
+        for host in self.hosts:
+            if host in stragglers:
+                logging.warning("Skipping %s, it missed an earlier deadline" % host)
+                result.skipped.append(host)
+            else:
+                hosts.append(host)
+        return hosts
+
+    def run(self, func, *args):
+        result = HostPoolResult(self.hosts)
+        queue = Queue.Queue()
+        for host in self._getHosts(result):
+            queue.put(host)
+
+        def worker():
+            while True:
+                try:
+                    host = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                if self.deadline:
+                    _hostdeadline.deadline = time.time() + self.deadline
+                try:
+                    result.results[host] = func(host, *args)
+                except Exception as e:
+                    logging.debug(traceback.format_exc())
+                    result._addError(host, e)
+                _hostdeadline.deadline = None
+
+        threads = []
+        for i in range(min(self.parallelism, len(self.hosts))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # join with a timeout so we stay responsive to KeyboardInterrupt
+            while thread.isAlive():
+                thread.join(1)
+        return result
+
+    def runScripts(self, build, logerrors=True):
+        """
+        Run the ScriptRunner returned by build(host) on every host, hosts
+        for which build returns None are skipped. Unlike run() all the
+        hosts are driven from the calling thread by one ExecutionLoop, so
+        parallelism can be set to thousands of hosts.
+        """
+        result = HostPoolResult(self.hosts)
+        loop = ExecutionLoop(self.parallelism)
+        runners = []
+        for host in self._getHosts(result):
+            try:
+                runner = build(host)
+            except Exception as e:
+                logging.debug(traceback.format_exc())
+                result._addError(host, e)
+                continue
+            if runner is None:
+                result.results[host] = None
+                continue
+            if runner.isProbed():
+                logging.debug("Skipping script on %s, its probes already passed" % runner.ip)
+                result.results[host] = 0
+                continue
+            runners.append((host, runner))
+
+        # Connection setup blocks, so get it out of the way with a few
+        # threads before the loop starts
+        ips = list(set([runner.ip for host, runner in runners if runner.ip]))
+        HostPool(ips, min(self.parallelism, CONNECT_THREADS)).run(_connect)
+
+        sessions = {}
+        for host, runner in runners:
+            session = ScriptSession(runner, logerrors, self.deadline)
+            sessions[session] = host
+            loop.add(session)
+
+        for session in loop.run():
+            host = sessions[session]
+            if session.error:
+                result._addError(host, session.error)
+            else:
+                session.runner.setProbed()
+                result.results[host] = session.returncode
+        return result
+
+FRAGMENT_MARKER = "@@PACKSTACK_FRAGMENT"
+# prints FRAGMENT_MARKER followed by its argument, without the marker
+# itself showing up in the bash -x trace of the command
+FRAGMENT_MARKER_CMD = "printf '%s_FRAGMENT %s\\n' @@PACKSTACK"
+
+class DeferredFragment(object):
+    """
+    A script queued by ScriptRunner.execute(defer=True), returncode and
+    the tail of the script's output are filled in once the queue is
+    flushed
+    """
+    def __init__(self, runner, logerrors):
+        self.runner = runner
+        self.logerrors = logerrors
+        self.returncode = None
+        self.tails = {"stdout": collections.deque(maxlen=OutputCapture.taillines),
+                      "stderr": collections.deque(maxlen=OutputCapture.taillines)}
+
+    def getTail(self, stream):
+        return "".join(self.tails[stream])
+
+class DeferredQueue(object):
+    """
+    Scripts deferred to the end of the current step. flush() runs all the
+    scripts queued for a host in a single session to that host, each one
+    in its own subshell so a failing script doesn't stop the others, and
+    maps the return code and output back to each of them.
+    """
+    def __init__(self):
+        self.fragments = {}
+        self.hosts = []
+        self.lock = threading.Lock()
+
+    def add(self, runner, logerrors=True):
+        fragment = DeferredFragment(runner, logerrors)
+        with self.lock:
+            if runner.ip not in self.fragments:
+                self.fragments[runner.ip] = []
+                self.hosts.append(runner.ip)
+            self.fragments[runner.ip].append(fragment)
+        return fragment
+
+    def clear(self):
+        with self.lock:
+            self.fragments = {}
+            self.hosts = []
+
+    def _buildRunner(self, host, fragments):
+        server = ScriptRunner(host)
+        # the fragments set their own ERR traps in their subshells
+        server.errexit = False
+        # the markers are printed with tracing turned off (quietly), so
+        # no trace lines of ours end up in a fragment's output
+        for i, fragment in enumerate(fragments):
+            server.append("{ set +x; } 2> /dev/null; %s %d; %s %d >&2; set -x" % (FRAGMENT_MARKER_CMD, i, FRAGMENT_MARKER_CMD, i))
+            server.append("( function t(){ exit $? ; } \n trap t ERR \n%s\n)" % "\n".join(fragment.runner.script))
+            server.append('{ rc=$?; set +x; } 2> /dev/null; %s "%d rc=$rc"; %s "%d rc=$rc" >&2; set -x' %
+                          (FRAGMENT_MARKER_CMD, i, FRAGMENT_MARKER_CMD, i))
+
+        current = {"stdout": None, "stderr": None}
+        def demux(host, stream, line):
+            # a fragment's last line may lack a newline, so the marker
+            # isn't necessarily at the start of the line
+            marker = line.find(FRAGMENT_MARKER + " ")
+            if marker > 0:
+                demux(host, stream, line[:marker])
+            if marker >= 0:
+                fields = line[marker:].split()
+                fragment = fragments[int(fields[1])]
+                if len(fields) > 2:
+                    fragment.returncode = int(fields[2][3:])
+                    current[stream] = None
+                else:
+                    current[stream] = fragment
+                return
+            fragment = current[stream]
+            if fragment:
+                fragment.tails[stream].append(line)
+                for callback in fragment.runner.callbacks:
+                    callback(host, stream, line)
+        server.addLineCallback(demux)
+        return server
+
+    def flush(self):
+        """
+        Run everything queued so far, raises an exception listing every
+        script that failed
+        """
+        with self.lock:
+            fragments = self.fragments
+            hosts = self.hosts
+            self.fragments = {}
+            self.hosts = []
+        if not hosts:
+            return
+
+        result = HostPool(hosts).runScripts(lambda host: self._buildRunner(host, fragments[host]), logerrors=False)
+
+        errors = []
+        for host in hosts:
+            if host in result.skipped or host in result.getStragglers():
+                logging.warning("Not checking deferred scripts of %s, it missed a deadline" % host)
+                continue
+            for fragment in fragments[host]:
+                if fragment.returncode == 0:
+                    fragment.runner.setProbed()
+                    continue
+                log = logging.debug
+                if fragment.logerrors:
+                    log = logging.error
+                log("============= STDERR %r (last %d lines) ==========" % (host, OutputCapture.taillines))
+                log(fragment.getTail("stderr"))
+                errors.append(fragment.runner.errmsg or output_messages.ERR_HOSTS_FAILED % host)
+        if errors:
+            raise Exception("\n".join(errors))
+deferred = DeferredQueue()
+
+class ProbeCache(object):
+    """
+    Remembers which idempotent probes (see ScriptRunner.appendProbe)
+    passed on which host, keyed by host, probe name and arguments. Probes
+    that passed during this run aren't run again, with a ttl results are
+    also saved in basedefs.DIR_STATE and reused by later runs for ttl
+    seconds. Failed probes are never remembered.
+    """
+    # seconds results are reused across runs, set from CONFIG_PROBE_CACHE_TTL
+    ttl = 0
+
+    def __init__(self):
+        self.passed = {}
+        self.thisrun = set()
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def _getPath(self):
+        return os.path.join(basedefs.DIR_STATE, "probes.json")
+
+    def _getKey(self, host, probe, args):
+        return json.dumps([host, probe] + [str(arg) for arg in args])
+
+    def _load(self):
+        self.loaded = True
+        if not ProbeCache.ttl or not os.path.exists(self._getPath()):
+            return
+        try:
+            with open(self._getPath()) as fp:
+                self.passed.update(json.load(fp))
+        except (IOError, ValueError):
+            logging.debug(traceback.format_exc())
+            logging.warning("Ignoring unreadable probe cache %s" % self._getPath())
+
+    def isPassed(self, host, probe, args):
+        key = self._getKey(host, probe, args)
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            if key in self.thisrun:
+                return True
+            return key in self.passed and time.time() - self.passed[key] < ProbeCache.ttl
+
+    def setPassed(self, host, probe, args):
+        key = self._getKey(host, probe, args)
+        with self.lock:
+            self.thisrun.add(key)
+            self.passed[key] = time.time()
+
+    def save(self):
+        """
+        Save the results still valid for ttl seconds, does nothing without
+        a ttl
+        """
+        if not ProbeCache.ttl:
+            return
+        with self.lock:
+            now = time.time()
+            passed = dict([(key, stamp) for key, stamp in self.passed.items() if now - stamp < ProbeCache.ttl])
+        path = self._getPath()
+        try:
+            if not os.path.isdir(basedefs.DIR_STATE):
+                os.makedirs(basedefs.DIR_STATE, 0700)
+            with open(path + ".tmp", "w") as fp:
+                json.dump(passed, fp)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            logging.warning(output_messages.ERR_PROBE_CACHE_SAVE % (path, e))
+probes = ProbeCache()
+
+class Template(object):
+    """
+    A file of text formatted with % against a dictionary, parsed once into
+    the literal text between its placeholders and the placeholders' keys
+    and conversions, so rendering it only looks up the keys it uses
+    """
+    # the same conversions as the % operator's
+    PLACEHOLDER_RE = re.compile(r"%(?:\(([^)]*)\))?([#0\- +]*(?:\*|\d+)?(?:\.(?:\*|\d+))?[hlL]?[diouxXeEfFgGcrs%])")
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path) as fp:
+            text = fp.read()
+        self.parts = []
+        literal = []
+        position = 0
+        for match in self.PLACEHOLDER_RE.finditer(text):
+            literal.append(text[position:match.start()])
+            position = match.end()
+            key, conversion = match.groups()
+            if conversion == "%":
+                literal.append("%")
+                continue
+            if key is None:
+                raise TypeError("format requires a mapping")
+            self.parts.append(("".join(literal), key, "%" + conversion))
+            literal = []
+        literal.append(text[position:])
+        self.tail = "".join(literal)
+        self.keys = frozenset([key for text, key, conversion in self.parts])
+
+    def render(self, values):
+        out = []
+        for text, key, conversion in self.parts:
+            out.append(text)
+            out.append(conversion % (values[key],))
+        out.append(self.tail)
+        return "".join(out)
+
+class TemplateCache(object):
+    """
+    Keeps the templates used during the run parsed, a template is read
+    again if its file was modified since it was parsed
+    """
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            template = self.templates.get(path)
+            if template is None or template.mtime != mtime:
+                template = Template(path)
+                self.templates[path] = template
+            return template
+templates = TemplateCache()
+
 class ScriptRunner(object):
+    # default seconds a script run on a host may take, set from
+    # CONFIG_HOST_TIMEOUT
+    timeout = 0
+
     def __init__(self, ip=None):
         self.script = []
         self.ip = ip
+        self.callbacks = []
+        # stop the script at the first failing command
+        self.errexit = True
+        self.errmsg = None
+        # (probe, args) of every probe appended, and how many lines they take
+        self.probes = []
+        self.probelines = 0
 
     def append(self, s):
         self.script.append(s)
 
-    def execute(self, logerrors=True):
-        script = "\n".join(self.script)
-        logging.debug("# ============ ssh : %r =========="%self.ip)
+    def appendProbe(self, probe, args, *lines):
+        """
+        Append the commands of an idempotent check, identified by the
+        probe name and its args. A script made of nothing but probes that
+        already passed on its host isn't run at all (see ProbeCache).
+        """
+        self.probes.append((probe, tuple(args)))
+        self.probelines += len(lines)
+        self.script.extend(lines)
+
+    def isProbed(self):
+        """
+        True if the script only has probes and they all passed before
+        """
+        if not self.probes or self.probelines != len(self.script) or not self.ip:
+            return False
+        for probe, args in self.probes:
+            if not probes.isPassed(self.ip, probe, args):
+                return False
+        return True
+
+    def setProbed(self):
+        """
+        Record the probes of the script as passed, called once it succeeded
+        """
+        if not self.ip:
+            return
+        for probe, args in self.probes:
+            probes.setPassed(self.ip, probe, args)
+
+    def addLineCallback(self, callback):
+        """
+        Register callback(host, stream, line) to be called for every line
+        of output while the script runs
+        """
+        self.callbacks.append(callback)
+
+    def execute(self, logerrors=True, defer=False, errmsg=None, timeout=None):
+        """
+        Run the script, raising an exception (with errmsg if given) if it
+        fails or a ScriptTimeoutException if it runs longer than timeout
+        seconds (0 for no limit). Scripts run on a host default to
+        ScriptRunner.timeout, local ones to no limit as they may be
+        working through many hosts, those should rather be run with a
+        HostPool so that each host gets its own deadline. With defer
+        the script is only queued and returns a DeferredFragment, it is
+        run together with any other deferred scripts for the same host at
+        the end of the current step.
+        """
+        self.errmsg = errmsg
+        if self.isProbed():
+            logging.debug("Skipping script on %s, its probes already passed" % self.ip)
+            return None
+        if defer:
+            return deferred.add(self, logerrors)
+        if timeout is None:
+            timeout = self.ip and ScriptRunner.timeout or 0
         if not False: #config.justprint:
-            _PIPE = subprocess.PIPE  # pylint: disable=E1101
-            if self.ip:
-                obj = subprocess.Popen(["ssh", "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null", "root@%s"%self.ip, "bash -x"], stdin=_PIPE, stdout=_PIPE, stderr=_PIPE, 
-                                        close_fds=True, shell=False)
-            else:
-                obj = subprocess.Popen(["bash", "-x"], stdin=_PIPE, stdout=_PIPE, stderr=_PIPE, 
-                                        close_fds=True, shell=False)
-
-            logging.debug(script)
-            script = "function t(){ exit $? ; } \n trap t ERR \n" + script
-            stdoutdata, stderrdata = obj.communicate(script)
-            logging.debug("============ STDOUT ==========")
-            logging.debug(stdoutdata)
-            _returncode = obj.returncode
-            if _returncode:
-                if logerrors:
-                    logging.error("============= STDERR ==========")
-                    logging.error(stderrdata)
-		else:
-                    logging.debug("============= STDERR ==========")
-                    logging.debug(stderrdata)
-                raise Exception("Error running remote script")
+            loop = ExecutionLoop()
+            session = ScriptSession(self, logerrors, timeout)
+            loop.add(session)
+            loop.run()
+            session.check()
+            self.setProbed()
         else:
-            logging.debug(script)
+            logging.debug("\n".join(self.script))
 
     def template(self, src, dst, varsdict):
-        with open(src) as fp:
-            self.append("cat > %s <<- EOF\n%s\nEOF\n"%(dst, fp.read()%varsdict))
+        self.append("cat > %s <<- EOF\n%s\nEOF\n"%(dst, templates.get(src).render(varsdict)))
 
     def ifnotexists(self, fn, s):
         self.append("[ -e %s ] || %s"%(fn, s))
@@ -348,20 +348,21 @@ def _isPathWriteable(path):
 
 def r_validateIF(server, device):
     """ Validate that a network interface exists on a remote host """
-    server.append("ifconfig %s || ( echo Device %s does not exist && exit 1 )"%(device, device))
+    server.appendProbe("ifconfig", [device], "ifconfig %s || ( echo Device %s does not exist && exit 1 )"%(device, device))
 
 def r_validateDevice(server, device=None):
     if device:
-        # the device MUST exist
-        server.append('ls -l /dev/%s'%device)
+        server.appendProbe("device", [device],
+            # the device MUST exist
+            'ls -l /dev/%s'%device,
 
-        # if it is not mounted then we can use it
-        server.append('grep "/dev/%s " /proc/self/mounts || exit 0'%device)
+            # if it is not mounted then we can use it
+            'grep "/dev/%s " /proc/self/mounts || exit 0'%device,
 
-        # if it is mounted then the mount point has to be in /srv/node
-        server.append('grep "/dev/%s /srv/node" /proc/self/mounts && exit 0'%device)
-        
-        # if we got here without exiting then we can't use this device
-        server.append('exit 1')
+            # if it is mounted then the mount point has to be in /srv/node
+            'grep "/dev/%s /srv/node" /proc/self/mounts && exit 0'%device,
+
+            # if we got here without exiting then we can't use this device
+            'exit 1')
     return False
 
@@ -70,7 +70,16 @@ ERR_EXP_FAILED_INIT_LOGGER="Unexpected error: Failed to initiate logger, please
 ERR_RC_CODE="Return Code is not zero"
 ERR_FAILURE="General failure"
 ERR_NO_ANSWER_FILE="Error: Could not find file %s"
+ERR_HOSTS_FAILED="Error running remote script on host(s): %s"
+ERR_SCRIPT_TIMEOUT="Remote script on %s didn't finish within %s seconds"
+ERR_PROBE_CACHE_SAVE="Failed to save the probe cache to %s: %s"
+ERR_PUPPET_APPLY="Puppet failed to apply %s on %s (exit code %s), see %s"
+ERR_PUPPET_STATE_SAVE="Failed to save the applied manifest state to %s: %s"
+ERR_PUPPET_ARCHIVE="Failed to create the puppet archive %s"
+ERR_UNKNOWN_TRANSPORT="Unknown transport %s, should be one of %s"
 
 # 
+INFO_STRAGGLERS="The following hosts didn't finish in time and were skipped for the rest of the run: %s"
+INFO_PUPPET_TIMINGS="The time puppet spent on each resource is reported in %s"
 INFO_KEYSTONERC="To use the command line tools simply source the keystonerc_* files created here"
 
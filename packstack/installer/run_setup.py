@@ -54,7 +54,7 @@ def initSequences():
                         'condition'       : [],
                         'condition_match' : [],
                         'steps'           : [ { 'title'     : "Pre Plugin Setup",
-                                                'functions' : [setDebug] },]
+                                                'functions' : [setDebug, setParallelism, setHostTimeout, setProbeCacheTTL, setTransport, setUseAgent] },]
                        },
                      ]
 
@@ -65,6 +65,22 @@ def setDebug():
     if controller.CONF['CONFIG_DEBUG'] == 'y':
         logging.root.setLevel(logging.DEBUG)
 
+def setParallelism():
+    utils.HostPool.parallelism = int(controller.CONF['CONFIG_PARALLELISM'])
+
+def setHostTimeout():
+    utils.HostPool.deadline = int(controller.CONF['CONFIG_HOST_TIMEOUT'])
+    utils.ScriptRunner.timeout = int(controller.CONF['CONFIG_HOST_TIMEOUT'])
+
+def setProbeCacheTTL():
+    utils.ProbeCache.ttl = int(controller.CONF['CONFIG_PROBE_CACHE_TTL'])
+
+def setTransport():
+    utils.setTransport(controller.CONF['CONFIG_TRANSPORT'])
+
+def setUseAgent():
+    utils.AgentPool.enabled = controller.CONF['CONFIG_USE_AGENT'] == 'y'
+
 def initConfig():
     """
     Initialization of configuration
@@ -99,6 +115,66 @@ def initConfig():
              "USE_DEFAULT"     : False,
              "NEED_CONFIRM"    : False,
              "CONDITION"       : False },
+            {"CMD_OPTION"      : "parallel-hosts",
+             "USAGE"           : "The maximum number of hosts to run remote commands on at the same time",
+             "PROMPT"          : "The maximum number of hosts to run remote commands on at the same time",
+             "OPTION_LIST"     : [],
+             "VALIDATION_FUNC" : validate.validateInteger,
+             "DEFAULT_VALUE"   : "10",
+             "MASK_INPUT"      : False,
+             "LOOSE_VALIDATION": False,
+             "CONF_NAME"       : "CONFIG_PARALLELISM",
+             "USE_DEFAULT"     : True,
+             "NEED_CONFIRM"    : False,
+             "CONDITION"       : False },
+            {"CMD_OPTION"      : "host-timeout",
+             "USAGE"           : "Seconds a host may spend on a single remote step before it is killed, skipped for the rest of the run and reported at the end, 0 for no limit",
+             "PROMPT"          : "Seconds a host may spend on a single remote step before it is killed, skipped for the rest of the run and reported at the end, 0 for no limit",
+             "OPTION_LIST"     : [],
+             "VALIDATION_FUNC" : validate.validateInteger,
+             "DEFAULT_VALUE"   : "0",
+             "MASK_INPUT"      : False,
+             "LOOSE_VALIDATION": False,
+             "CONF_NAME"       : "CONFIG_HOST_TIMEOUT",
+             "USE_DEFAULT"     : True,
+             "NEED_CONFIRM"    : False,
+             "CONDITION"       : False },
+            {"CMD_OPTION"      : "probe-cache-ttl",
+             "USAGE"           : "Seconds the results of host checks (e.g. network devices, volume groups) are reused by later packstack runs, 0 to check again on every run",
+             "PROMPT"          : "Seconds the results of host checks are reused by later packstack runs, 0 to check again on every run",
+             "OPTION_LIST"     : [],
+             "VALIDATION_FUNC" : validate.validateInteger,
+             "DEFAULT_VALUE"   : "0",
+             "MASK_INPUT"      : False,
+             "LOOSE_VALIDATION": False,
+             "CONF_NAME"       : "CONFIG_PROBE_CACHE_TTL",
+             "USE_DEFAULT"     : True,
+             "NEED_CONFIRM"    : False,
+             "CONDITION"       : False },
+            {"CMD_OPTION"      : "transport",
+             "USAGE"           : "How commands are run on the hosts: ssh, local to run every host's commands on this machine, or simulated to stand in for each host with a sandbox directory on this machine (the PACKSTACK_TRANSPORT environment variable overrides this)",
+             "PROMPT"          : "How commands are run on the hosts: ssh, local or simulated",
+             "OPTION_LIST"     : ["ssh", "local", "simulated"],
+             "VALIDATION_FUNC" : validate.validateOptions,
+             "DEFAULT_VALUE"   : "ssh",
+             "MASK_INPUT"      : False,
+             "LOOSE_VALIDATION": False,
+             "CONF_NAME"       : "CONFIG_TRANSPORT",
+             "USE_DEFAULT"     : True,
+             "NEED_CONFIRM"    : False,
+             "CONDITION"       : False },
+            {"CMD_OPTION"      : "use-agent",
+             "USAGE"           : "Run remote commands through a long lived packstack agent on each host instead of a new ssh session per command",
+             "PROMPT"          : "Run remote commands through a long lived packstack agent on each host instead of a new ssh session per command",
+             "OPTION_LIST"     : ["y", "n"],
+             "VALIDATION_FUNC" : validate.validateOptions,
+             "DEFAULT_VALUE"   : "n",
+             "MASK_INPUT"      : False,
+             "LOOSE_VALIDATION": False,
+             "CONF_NAME"       : "CONFIG_USE_AGENT",
+             "USE_DEFAULT"     : True,
+             "NEED_CONFIRM"    : False,
+             "CONDITION"       : False },
         ]
     }
     """
@@ -349,11 +425,16 @@ def _loadParamFromFile(config, section, paramName):
     and load to to global conf dict
     """
 
-    # Get paramName from answer file
-    value = config.get(section, paramName)
+    param = controller.getParamByName(paramName)
+
+    # Get paramName from answer file, params that are never prompted for
+    # may be missing from answer files generated by older versions
+    if param.getKey("USE_DEFAULT") and not config.has_option(section, paramName):
+        value = param.getKey("DEFAULT_VALUE")
+    else:
+        value = config.get(section, paramName)
 
     # Validate param value using its validation func
-    param = controller.getParamByName(paramName)
     _validateParamValue(param, value)
 
     # Keep param value in our never ending global conf
@@ -540,6 +621,8 @@ def _addFinalInfoMsg():
     add info msg to the user finalizing the
     successfull install of rhemv
     """
+    if utils.stragglers:
+        controller.MESSAGES.append(output_messages.INFO_STRAGGLERS % ", ".join(sorted(utils.stragglers)))
     controller.MESSAGES.append(output_messages.INFO_LOG_FILE_PATH%(logFile))
     controller.MESSAGES.append(output_messages.INFO_KEYSTONERC)
 
@@ -605,6 +688,11 @@ def _main(configFile=None):
         _printAdditionalMessages()
 
     finally:
+        # Tear down any agents and connections opened during the run
+        utils.agents.closeAll()
+        utils.transport.closeAll()
+        utils.probes.save()
+
         # Always print user params to log
         _summaryParamsToLog()
 
@@ -5,13 +5,73 @@ steps and replaces the CONF dictionary.
 from setup_params import Group
 from setup_sequences import Sequence
 
+class ConfDict(dict):
+    """
+    The CONF dictionary, hostversion is incremented every time a *_HOST or
+    *_HOSTS key changes so that what is worked out from the hosts can be
+    kept until then
+    """
+    # keys only holding the host a plugin is writing a manifest for at the
+    # moment, that host is already named by another key (ospluginutils
+    # sets this to its TEMPORARY_KEYS)
+    scratchkeys = frozenset()
+
+    @classmethod
+    def isHostKey(cls, key):
+        """
+        True if key names hosts to install
+        """
+        return (isinstance(key, basestring) and key not in cls.scratchkeys and
+                (key.endswith("_HOST") or key.endswith("_HOSTS")))
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.hostversion = 0
+        self.update(*args, **kwargs)
+
+    def _changed(self, key):
+        if self.isHostKey(key):
+            self.hostversion += 1
+
+    def __setitem__(self, key, value):
+        if key not in self or self[key] != value:
+            self._changed(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            self._changed(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._changed(key)
+        return key, value
+
+    def clear(self):
+        dict.clear(self)
+        self.hostversion += 1
+
 class Controller(object):
 
     __GROUPS=[]
     __SEQUENCES=[]
     __PLUGINS=[]
     MESSAGES=[]
-    CONF={}
+    CONF=ConfDict()
 
     __single = None # the one, true Singleton
 
@@ -60,8 +60,16 @@ class Step(object):
                 function()
             except:
                 logging.debug(traceback.format_exc())
+                utils.deferred.clear()
                 print ("[ " + utils.getColoredText(output_messages.INFO_ERROR, basedefs.RED) + " ]").rjust(spaceLen)
                 raise
+        # Run any remote scripts the functions deferred, one session per host
+        try:
+            utils.deferred.flush()
+        except:
+            logging.debug(traceback.format_exc())
+            print ("[ " + utils.getColoredText(output_messages.INFO_ERROR, basedefs.RED) + " ]").rjust(spaceLen)
+            raise
         print ("[ " + utils.getColoredText(output_messages.INFO_DONE, basedefs.GREEN) + " ]").rjust(spaceLen)
 
 class Sequence(object):
@@ -0,0 +1,278 @@
+"""
+Transports used to run commands on the hosts being installed.
+
+Everything the installer runs on a host goes through the transport's
+getArgs(), which turns a shell command into the argument list of a local
+process running it on the host. The ssh transport is the one used for
+real installs, the local and simulated transports run every "host" on the
+machine packstack is running on.
+"""
+import logging
+import os
+import pipes
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import basedefs
+import output_messages
+
+SSH_OPTIONS = ["-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null"]
+
+class Transport(object):
+    """
+    Base class of the transports, runs the commands of every host on this
+    machine, subclasses reaching the hosts some other way override
+    getArgs()
+    """
+    name = None
+
+    def connect(self, host):
+        """
+        Set up whatever is needed to reach host, called ahead of time for
+        hosts about to be used so that it isn't done while commands run
+        """
+        pass
+
+    def getArgs(self, host, command, forwardagent=False):
+        """
+        Returns the argument list of a local process that runs the shell
+        command on host, the process's stdin/stdout/stderr are those of
+        the command. With forwardagent the command may itself use
+        getRelayCommand() to reach other hosts.
+        """
+        return ["bash", "-c", command]
+
+    def getCommand(self, host, command, forwardagent=False):
+        """
+        Same as getArgs but quoted for use in a shell pipeline
+        """
+        return " ".join([pipes.quote(arg) for arg in self.getArgs(host, command, forwardagent)])
+
+    def canRelay(self):
+        """
+        True if hosts can run commands on each other with getRelayCommand()
+        """
+        return True
+
+    def getRelayCommand(self, fromhost, tohost, command):
+        """
+        Returns the shell command fromhost runs to run command on tohost
+        """
+        # the hosts are all on this machine, they reach each other like we do
+        return self.getCommand(tohost, command)
+
+    def closeAll(self):
+        """
+        Release everything set up during the run
+        """
+        pass
+
+class SshTransport(Transport):
+    """
+    Runs commands over ssh as root. A single ssh master connection is
+    kept open per remote host for the duration of a run, every ssh session
+    to the host is then multiplexed over the master socket instead of
+    doing a new TCP/auth handshake. Masters are opened lazily the first
+    time a host is used and closed by closeAll().
+    """
+    name = "ssh"
+
+    def __init__(self):
+        self.controldir = None
+        self.masters = {}
+        # control sockets handed out so far, masters to several hosts are
+        # usually being opened at once
+        self.controlpaths = 0
+        self.hostlocks = {}
+        self.lock = threading.Lock()
+        # only one password prompt may own the terminal at a time
+        self.interactivelock = threading.Lock()
+
+    def _getControlDir(self):
+        # unix socket paths are limited to ~100 chars so keep this short
+        if not self.controldir:
+            self.controldir = tempfile.mkdtemp(prefix="packstack-ssh-")
+        return self.controldir
+
+    def _getHostLock(self, host):
+        with self.lock:
+            if host not in self.hostlocks:
+                self.hostlocks[host] = threading.Lock()
+            return self.hostlocks[host]
+
+    def _openMaster(self, host):
+        """
+        Start a backgrounded ssh master for host, returns the control socket
+        path or None if the master couldn't be started
+        """
+        with self.lock:
+            self.controlpaths += 1
+            controlpath = os.path.join(self._getControlDir(), "%d" % self.controlpaths)
+        cmd = ["ssh", "-M", "-N", "-f", "-o", "ControlPath=%s" % controlpath] + SSH_OPTIONS + ["root@%s" % host]
+        logging.debug("Opening ssh master connection to %s (%s)" % (host, controlpath))
+        # ssh forks into the background once authenticated, we don't want the
+        # master holding on to any pipes of ours so discard its output
+        with open(os.devnull, "r+") as devnull:
+            # Hosts are usually connected to in parallel so try key based
+            # auth first, and only fall back to prompting one host at a time
+            rc = subprocess.call(cmd[:1] + ["-o", "BatchMode=yes"] + cmd[1:], stdin=devnull,
+                                 stdout=devnull, stderr=devnull, close_fds=True)
+            if rc != 0:
+                with self.interactivelock:
+                    rc = subprocess.call(cmd, stdin=devnull, stdout=devnull, close_fds=True)
+        if rc != 0:
+            logging.warning("Failed to open ssh master connection to %s, not multiplexing" % host)
+            return None
+        return controlpath
+
+    def getControlPath(self, host):
+        with self._getHostLock(host):
+            if host not in self.masters:
+                self.masters[host] = self._openMaster(host)
+            return self.masters[host]
+
+    def connect(self, host):
+        self.getControlPath(host)
+
+    def getSshArgs(self, host):
+        """
+        Returns the ssh argument list (without remote command) used to
+        connect to host over its master connection
+        """
+        args = ["ssh"] + SSH_OPTIONS
+        controlpath = self.getControlPath(host)
+        if controlpath:
+            args += ["-o", "ControlMaster=no", "-o", "ControlPath=%s" % controlpath]
+        return args + ["root@%s" % host]
+
+    def getArgs(self, host, command, forwardagent=False):
+        args = self.getSshArgs(host)
+        if forwardagent:
+            args[1:1] = ["-A"]
+        return args + [command]
+
+    def canRelay(self):
+        # hosts authenticate to each other with our keys through the
+        # forwarded agent
+        return bool(os.environ.get("SSH_AUTH_SOCK"))
+
+    def getRelayCommand(self, fromhost, tohost, command):
+        args = ["ssh"] + SSH_OPTIONS + ["-o", "BatchMode=yes", "root@%s" % tohost, command]
+        return " ".join([pipes.quote(arg) for arg in args])
+
+    def closeAll(self):
+        with self.lock:
+            with open(os.devnull, "r+") as devnull:
+                for host, controlpath in self.masters.items():
+                    if not controlpath:
+                        continue
+                    logging.debug("Closing ssh master connection to %s" % host)
+                    cmd = ["ssh", "-O", "exit", "-o", "ControlPath=%s" % controlpath] + SSH_OPTIONS + ["root@%s" % host]
+                    subprocess.call(cmd, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True)
+            self.masters = {}
+            self.hostlocks = {}
+            if self.controldir:
+                shutil.rmtree(self.controldir, ignore_errors=True)
+                self.controldir = None
+
+class LocalTransport(Transport):
+    """
+    Runs the commands of every host on the local machine, for all in one
+    installs that don't want to go through sshd
+    """
+    name = "local"
+
+class SimulatedTransport(Transport):
+    """
+    Stands in for a fleet of hosts on the local machine, e.g. to measure
+    the installer's own overhead with hundreds of hosts. Each host gets a
+    sandbox directory under PACKSTACK_SIM_ROOT (a temporary directory by
+    default) which its commands run in, with HOME pointing to it and the
+    host name in PACKSTACK_SIM_HOST. Executables placed in
+    PACKSTACK_SIM_STUBS are found before the system's ones, so commands
+    that shouldn't really run (yum, puppet, ...) can be replaced by stubs.
+    The absolute paths the installer uses on the hosts (VAR_DIR and the
+    module cache), and those listed in PACKSTACK_SIM_PATHS separated by
+    ":", are moved under the host's sandbox in its commands, so hosts
+    don't share them with each other or with this machine.
+
+    PACKSTACK_SIM_LATENCY adds that many seconds before each command,
+    PACKSTACK_SIM_FAILURE_RATE is the probability (0 to 1) that a command
+    fails the way a dropped ssh connection does, with exit code 255.
+    """
+    name = "simulated"
+
+    def __init__(self):
+        self.root = os.environ.get("PACKSTACK_SIM_ROOT")
+        self.ownroot = False
+        self.stubs = os.environ.get("PACKSTACK_SIM_STUBS")
+        self.latency = float(os.environ.get("PACKSTACK_SIM_LATENCY", 0))
+        self.failurerate = float(os.environ.get("PACKSTACK_SIM_FAILURE_RATE", 0))
+        self.paths = [path for path in os.environ.get("PACKSTACK_SIM_PATHS", "").split(":") if path]
+        self.sandboxes = {}
+        self.lock = threading.Lock()
+
+    def _getPathsRE(self):
+        paths = [basedefs.VAR_DIR, basedefs.REMOTE_MODULE_CACHE_DIR] + self.paths
+        paths = sorted(set([path.rstrip("/") for path in paths if os.path.isabs(path)]), key=len, reverse=True)
+        # whole paths only, not paths that are already part of a longer
+        # one, e.g. in the command of another host this one relays to
+        return re.compile(r"(?<![\w.\-/])(%s)(?![\w.\-])" % "|".join([re.escape(path) for path in paths]))
+
+    def rootPaths(self, host, command):
+        """
+        Returns command with the installer's paths moved under the
+        sandbox of host
+        """
+        sandbox = self.getSandbox(host)
+        return self._getPathsRE().sub(lambda match: sandbox + match.group(1), command)
+
+    def getSandbox(self, host):
+        with self.lock:
+            if not self.root:
+                self.root = tempfile.mkdtemp(prefix="packstack-sim-")
+                self.ownroot = True
+            if host not in self.sandboxes:
+                sandbox = os.path.join(self.root, host)
+                if not os.path.isdir(sandbox):
+                    os.makedirs(sandbox)
+                self.sandboxes[host] = sandbox
+            return self.sandboxes[host]
+
+    def getArgs(self, host, command, forwardagent=False):
+        sandbox = self.getSandbox(host)
+        prefix = ""
+        if self.latency:
+            prefix = "sleep %s; " % self.latency
+        if self.failurerate and random.random() < self.failurerate:
+            return ["bash", "-c", prefix + "echo 'Simulated connection failure to %s' >&2; exit 255" % host]
+        command = self.rootPaths(host, command)
+        env = ["PACKSTACK_SIM_HOST=%s" % pipes.quote(host), "HOME=%s" % pipes.quote(sandbox)]
+        if self.stubs:
+            env.append("PATH=%s:$PATH" % pipes.quote(self.stubs))
+        return ["bash", "-c", "%scd %s && %s exec bash -c %s" % (prefix, pipes.quote(sandbox), " ".join(env),
+                                                               pipes.quote(command))]
+
+    def closeAll(self):
+        with self.lock:
+            if self.ownroot:
+                shutil.rmtree(self.root, ignore_errors=True)
+                self.root = None
+                self.ownroot = False
+            self.sandboxes = {}
+
+TRANSPORTS = {"ssh": SshTransport, "local": LocalTransport, "simulated": SimulatedTransport}
+
+def getTransport(name):
+    """
+    Returns a new transport of the given name, the PACKSTACK_TRANSPORT
+    environment variable overrides it if set
+    """
+    name = os.environ.get("PACKSTACK_TRANSPORT") or name
+    if name not in TRANSPORTS:
+        raise Exception(output_messages.ERR_UNKNOWN_TRANSPORT % (name, ", ".join(sorted(TRANSPORTS))))
+    return TRANSPORTS[name]()
@@ -2,7 +2,8 @@
 import os, socket
 
 from packstack.installer import basedefs
-from packstack.installer.setup_controller import Controller
+import packstack.installer.common_utils as utils
+from packstack.installer.setup_controller import Controller, ConfDict
 
 controller = Controller()
 
@@ -32,47 +33,214 @@ class NovaConfig(object):
 
 class ManifestFiles(object):
     def __init__(self):
-        self.filelist = []
+        self.clear()
 
     # continuous manifest file that have the same marker can be 
     # installed in parallel, if on different servers
-    def addFile(self, filename, marker):
-        for f,p in self.filelist:
-            if f == filename:
-                return
+    # a manifest waits for every manifest before its marker's group to
+    # be applied, unless it lists the markers it requires, then it only
+    # waits for those and for earlier manifests on its own host. A file
+    # added several times waits for the markers all its parts list, or for
+    # every manifest before it as soon as one part doesn't list any
+    def addFile(self, filename, marker, requires=None):
+        if filename in self.phaseof:
+            if requires is None:
+                self.requires.pop(filename, None)
+            elif filename in self.requires:
+                self.requires[filename] = self.requires[filename] + [r for r in requires if r not in self.requires[filename]]
+            return
         self.filelist.append((filename, marker,))
+        if requires is not None:
+            self.requires[filename] = list(requires)
+
+        if not self.phases or self.phases[-1][0] != marker:
+            self.phases.append((marker, []))
+        phase = len(self.phases) - 1
+        self.phases[-1][1].append(filename)
+        self.phaseof[filename] = phase
+        host = self.getHost(filename)
+        self.byhost.setdefault(host, []).append(filename)
+        self.byhostphase.setdefault((host, phase), []).append(filename)
+        self.bymarker.setdefault(marker, []).append(filename)
 
     def getFiles(self):
         return [f for f in self.filelist]
+
+    def clear(self):
+        self.filelist = []
+        self.requires = {}
+        self.keys = {}
+        self.data = {}
+        # (marker, files) of each run of files with the same marker
+        self.phases = []
+        self.phaseof = {}
+        self.byhost = {}
+        self.byhostphase = {}
+        self.bymarker = {}
+
+    # manifests are named after the host they are for followed by "_",
+    # host names may have "_" in them too so the longest prefix that is
+    # a known host is taken
+    def getHost(self, filename):
+        name = os.path.basename(filename)
+        inventory = getHostInventory(controller.CONF)
+        position = name.rfind("_")
+        while position > 0:
+            if inventory.hasHost(name[:position]):
+                return name[:position]
+            position = name.rfind("_", 0, position)
+        return name.split("_", 1)[0]
+
+    def getPhases(self):
+        return [(m, list(files)) for m, files in self.phases]
+
+    def getPhase(self, filename):
+        return self.phaseof[filename]
+
+    def getHostFiles(self, host, phase=None):
+        if phase is None:
+            return list(self.byhost.get(host, []))
+        return list(self.byhostphase.get((host, phase), []))
+
+    def getMarkerFiles(self, marker):
+        return list(self.bymarker.get(marker, []))
+
+    def getRequires(self, filename):
+        return self.requires.get(filename)
+
+    # the CONF keys a manifest's content depends on
+    def addKeys(self, filename, keys):
+        self.keys[filename] = self.keys.get(filename, frozenset()) | frozenset(keys)
+
+    def getKeys(self, filename):
+        return self.keys.get(filename, frozenset())
+
+    def getAffectedFiles(self, keys):
+        keys = frozenset(keys)
+        return [f for f,p in self.filelist if self.getKeys(f) & keys]
+
+    # manifests are built in memory and only written by writeFiles
+    def addData(self, filename, data):
+        self.data.setdefault(filename, []).append(data)
+
+    def getData(self, filename):
+        return "".join(self.data.get(filename, []))
+
+    def writeFiles(self):
+        if not os.path.exists(basedefs.PUPPET_MANIFEST_DIR):
+            os.mkdir(basedefs.PUPPET_MANIFEST_DIR)
+        for f,p in self.filelist:
+            with open(f + ".tmp", 'w') as fp:
+                fp.write(self.getData(f))
+            os.rename(f + ".tmp", f)
 manifestfiles = ManifestFiles()
 
+# (output, keys) of the templates rendered since the last appendManifestFile
+_rendered = []
+
+# CONF keys plugins set to another value for each host they render
+# manifests for, with the answer the values come from. Manifests depend
+# on that answer instead, the key's current value is only the last
+# host's.
+TEMPORARY_KEYS = {
+    "CONFIG_NOVA_COMPUTE_HOST": "CONFIG_NOVA_COMPUTE_HOSTS",
+    "CONFIG_NOVA_COMPUTE_IP": "CONFIG_NOVA_COMPUTE_HOSTS",
+    "CONFIG_SWIFT_STORAGE_CURRENT": "CONFIG_SWIFT_STORAGE_HOSTS",
+    "SWIFT_STORAGE_DEVICES": "CONFIG_SWIFT_STORAGE_HOSTS",
+}
+# setting them for each host mustn't look like the hosts changed
+ConfDict.scratchkeys = frozenset(TEMPORARY_KEYS)
+
+def getTemplateKeys(template_name):
+    return utils.templates.get(os.path.join(PUPPET_TEMPLATE_DIR, template_name)).keys
+
 def getManifestTemplate(template_name):
-    with open(os.path.join(PUPPET_TEMPLATE_DIR, template_name)) as fp:
-        return fp.read()%controller.CONF
+    template = utils.templates.get(os.path.join(PUPPET_TEMPLATE_DIR, template_name))
+    data = template.render(controller.CONF)
+    _rendered.append((data, template.keys))
+    return data
 
-def appendManifestFile(manifest_name, data, marker=''):
-    if not os.path.exists(basedefs.PUPPET_MANIFEST_DIR):
-        os.mkdir(basedefs.PUPPET_MANIFEST_DIR)
+# keys is for CONF keys the data depends on other than those of the
+# templates rendered for it
+def appendManifestFile(manifest_name, data, marker='', requires=None, keys=()):
     manifestfile = os.path.join(basedefs.PUPPET_MANIFEST_DIR, manifest_name)
-    manifestfiles.addFile(manifestfile, marker)
-    with open(manifestfile, 'a') as fp:
-        fp.write("\n")
-        fp.write(data)
+    manifestfiles.addFile(manifestfile, marker, requires)
+    # only the templates whose output was kept count
+    keys = set(keys)
+    for rendered, templatekeys in _rendered:
+        if rendered in data:
+            keys.update(templatekeys)
+    del _rendered[:]
+    manifestfiles.addKeys(manifestfile, [TEMPORARY_KEYS.get(key, key) for key in keys])
+    manifestfiles.addData(manifestfile, "\n" + data)
    
+class HostInventory(object):
+    """
+    The hosts named by the *_HOST and *_HOSTS keys of a CONF (other than
+    the TEMPORARY_KEYS), with the keys naming each host (its roles) and
+    the devices given with it as host/device
+    """
+    def __init__(self, CONF):
+        self.hosts = []
+        self.roles = {}
+        self.devices = {}
+        for key,value in CONF.items():
+            if not ConfDict.isHostKey(key):
+                continue
+            if key.endswith("_HOST"):
+                entries = [value]
+            else:
+                entries = value.split(",")
+            for entry in entries:
+                entry = entry.strip().split('/')
+                host = entry[0]
+                if host not in self.roles:
+                    self.hosts.append(host)
+                    self.roles[host] = []
+                    self.devices[host] = []
+                if key not in self.roles[host]:
+                    self.roles[host].append(key)
+                if len(entry) > 1 and entry[1] not in self.devices[host]:
+                    self.devices[host].append(entry[1])
+
+    def getHosts(self):
+        return list(self.hosts)
+
+    def hasHost(self, host):
+        return host in self.roles
+
+    def getRoles(self, host):
+        return list(self.roles.get(host, []))
+
+    def getDevices(self, host):
+        return list(self.devices.get(host, []))
+
+# the inventory of the last CONF and its hostversion when it was built
+_inventory = (None, None, None)
+
+def getHostInventory(CONF):
+    global _inventory
+    version = getattr(CONF, "hostversion", None)
+    conf, built, inventory = _inventory
+    if conf is not CONF or version is None or built != version:
+        inventory = HostInventory(CONF)
+        _inventory = (CONF, version, inventory)
+    return inventory
+
 def gethostlist(CONF):
-    hosts = []
-    for key,value in CONF.items():
-        if key.endswith("_HOST"):
-            value = value.split('/')[0]
-            if value not in hosts:
-                hosts.append(value)
-        if key.endswith("_HOSTS"):
-            for host in value.split(","):
-                host = host.strip()
-                host = host.split('/')[0]
-                if host not in hosts:
-                    hosts.append(host)
-    return hosts
+    return getHostInventory(CONF).getHosts()
+
+def getAffectedManifests(keys):
+    """
+    Returns the (host, manifest) of the manifests whose content depends on
+    any of the CONF keys in keys
+    """
+    hosts = set(gethostlist(controller.CONF))
+    affected = []
+    for manifest in manifestfiles.getAffectedFiles(keys):
+        if manifestfiles.getHost(manifest) in hosts:
+            affected.append((manifestfiles.getHost(manifest), manifest))
+    return affected
 
 class PackStackException(BaseException):
     def __init__(self, msg):
@@ -61,12 +61,8 @@ def initSequences(controller):
 
 def checkcindervg():
     server = utils.ScriptRunner(controller.CONF['CONFIG_CINDER_HOST'])
-    server.append('vgdisplay cinder-volumes')
-    try:
-        server.execute()
-    except:
-        print "The cinder server should contain a cinder-volumes volume group"
-        raise
+    server.appendProbe('vgdisplay', ['cinder-volumes'], 'vgdisplay cinder-volumes')
+    server.execute(defer=True, errmsg="The cinder server should contain a cinder-volumes volume group")
 
 def createkeystonemanifest():
     manifestfile = "%s_keystone.pp"%controller.CONF['CONFIG_KEYSTONE_HOST']
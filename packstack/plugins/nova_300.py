@@ -214,20 +214,25 @@ def createcomputemanifest():
         manifestdata = getManifestTemplate("nova_compute.pp")
         manifestfile = "%s_nova.pp"%host
 
-        server = utils.ScriptRunner(host)
         nova_config_options = NovaConfig()
 
         if host != controller.CONF["CONFIG_NOVA_NETWORK_HOST"]:
             nova_config_options.addOption("flat_interface", controller.CONF['CONFIG_NOVA_COMPUTE_PRIVIF'])
+            # checked together with any other deferred checks for this
+            # host at the end of the step
+            server = utils.ScriptRunner(host)
             validate.r_validateIF(server, controller.CONF['CONFIG_NOVA_COMPUTE_PRIVIF'])
+            server.execute(defer=True)
 
         # if on a vm we need to set libvirt_cpu_mode to "none"
         # see https://bugzilla.redhat.com/show_bug.cgi?id=858311
         if controller.CONF["CONFIG_LIBVIRT_TYPE"] == "qemu":
             nova_config_options.addOption("libvirt_cpu_mode", "none")
 
-        server.execute()
-        appendManifestFile(manifestfile, manifestdata + "\n" + nova_config_options.getManifestEntry())
+        # compute hosts only need the database and message broker, and
+        # nova's tables, which the api host's db sync creates
+        appendManifestFile(manifestfile, manifestdata + "\n" + nova_config_options.getManifestEntry(), requires=['pre', 'novaapi'],
+                           keys=['CONFIG_NOVA_NETWORK_HOST', 'CONFIG_NOVA_COMPUTE_PRIVIF', 'CONFIG_LIBVIRT_TYPE'])
 
 def createnetworkmanifest():
     hostname = controller.CONF['CONFIG_NOVA_NETWORK_HOST']
@@ -235,7 +240,7 @@ def createnetworkmanifest():
     server = utils.ScriptRunner(hostname)
     validate.r_validateIF(server, controller.CONF['CONFIG_NOVA_NETWORK_PRIVIF'])
     validate.r_validateIF(server, controller.CONF['CONFIG_NOVA_NETWORK_PUBIF'])
-    server.execute()
+    server.execute(defer=True)
 
     manifestfile = "%s_nova.pp"%hostname
     manifestdata = getManifestTemplate("nova_network.pp")
@@ -255,7 +260,8 @@ def createcommonmanifest():
     for manifestfile, marker in manifestfiles.getFiles():
         if manifestfile.endswith("_nova.pp"):
             data = getManifestTemplate("nova_common.pp")
-            appendManifestFile(os.path.split(manifestfile)[1], data)
+            # only points nova to the database and message broker
+            appendManifestFile(os.path.split(manifestfile)[1], data, requires=['pre'])
 
 def __get_libvirt_type_default():
     with open('/proc/cpuinfo','r') as f:
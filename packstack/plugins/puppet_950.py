@@ -1,15 +1,20 @@
 """
 Installs and configures puppet
 """
+import glob
+import hashlib
+import json
 import logging
 import os
 import platform
-import time
+import re
+import tarfile
 
-from packstack.installer import basedefs
+import packstack.installer.engine_validators as validate
+from packstack.installer import basedefs, output_messages
 import packstack.installer.common_utils as utils
 
-from packstack.modules.ospluginutils import gethostlist, manifestfiles
+from packstack.modules.ospluginutils import gethostlist, manifestfiles, TEMPORARY_KEYS
 
 # Controller object will be initialized from main flow
 controller = None
@@ -28,6 +33,42 @@ def initConfig(controllerObject):
     controller = controllerObject
     logging.debug("Adding Openstack Puppet configuration")
     paramsList = [
+                  {"CMD_OPTION"      : "puppet-merge-manifests",
+                   "USAGE"           : "Combine the manifests of each host that can be applied together into a single puppet run, the manifests must not declare the same resources",
+                   "PROMPT"          : "Combine the manifests of each host that can be applied together into a single puppet run",
+                   "OPTION_LIST"     : ["y", "n"],
+                   "VALIDATION_FUNC" : validate.validateOptions,
+                   "DEFAULT_VALUE"   : "n",
+                   "MASK_INPUT"      : False,
+                   "LOOSE_VALIDATION": False,
+                   "CONF_NAME"       : "CONFIG_PUPPET_MERGE_MANIFESTS",
+                   "USE_DEFAULT"     : True,
+                   "NEED_CONFIRM"    : False,
+                   "CONDITION"       : False },
+                  {"CMD_OPTION"      : "puppet-relay-fanout",
+                   "USAGE"           : "Have hosts that received the puppet modules forward them to this many other hosts each instead of sending them to every host from here, for large numbers of hosts (needs a running ssh-agent), 0 to send them from here",
+                   "PROMPT"          : "Number of hosts each host forwards the puppet modules to, 0 to send them to every host from here",
+                   "OPTION_LIST"     : [],
+                   "VALIDATION_FUNC" : validate.validateInteger,
+                   "DEFAULT_VALUE"   : "0",
+                   "MASK_INPUT"      : False,
+                   "LOOSE_VALIDATION": False,
+                   "CONF_NAME"       : "CONFIG_PUPPET_RELAY_FANOUT",
+                   "USE_DEFAULT"     : True,
+                   "NEED_CONFIRM"    : False,
+                   "CONDITION"       : False },
+                  {"CMD_OPTION"      : "puppet-force-apply",
+                   "USAGE"           : "Apply the manifests on every host, including hosts whose manifests and puppet modules are the same as when they were last applied successfully",
+                   "PROMPT"          : "Apply the manifests on hosts whose manifests and puppet modules didn't change",
+                   "OPTION_LIST"     : ["y", "n"],
+                   "VALIDATION_FUNC" : validate.validateOptions,
+                   "DEFAULT_VALUE"   : "n",
+                   "MASK_INPUT"      : False,
+                   "LOOSE_VALIDATION": False,
+                   "CONF_NAME"       : "CONFIG_PUPPET_FORCE_APPLY",
+                   "USE_DEFAULT"     : True,
+                   "NEED_CONFIRM"    : False,
+                   "CONDITION"       : False },
                  ]
 
     groupDict = { "GROUP_NAME"            : "PUPPET",
@@ -48,6 +89,8 @@ def initSequences(controller):
 
     puppetsteps = [
              {'title': 'Installing Puppet', 'functions':[installpuppet]},
+             {'title': 'Merging Puppet manifests', 'functions':[mergePuppetManifests]},
+             {'title': 'Writing Puppet manifests', 'functions':[writePuppetManifests]},
              {'title': 'Copying Puppet modules/manifests', 'functions':[copyPuppetModules]},
              {'title': 'Applying Puppet manifests', 'functions':[applyPuppetManifest]},
     ]
@@ -59,62 +102,683 @@ def runCleanup():
     localserver.execute()
 
 def installpuppet():
-    for hostname in gethostlist(controller.CONF):
+    def install(hostname):
         server = utils.ScriptRunner(hostname)
-        server.append("rpm -q puppet || yum install -y puppet")
-        server.execute()
+        server.appendProbe("puppet", [], "rpm -q puppet || yum install -y puppet")
+        return server
+    utils.HostPool(gethostlist(controller.CONF)).runScripts(install).raiseOnError()
+
+def mergePuppetManifests():
+    """
+    Replace the manifests of each host that are in the same marker group
+    by a single manifest, so they are applied by one puppet run. The
+    original manifests are delimited by comments in the merged one, and
+    a .map file next to it lists the lines each of them starts and ends
+    at.
+    """
+    if controller.CONF['CONFIG_PUPPET_MERGE_MANIFESTS'] != 'y':
+        return
+
+    groups = manifestfiles.getPhases()
+    hostlist = set(gethostlist(controller.CONF))
+    files = []
+    keys = {}
+    data = {}
+    for manifest, marker in manifestfiles.getFiles():
+        keys[manifest] = manifestfiles.getKeys(manifest)
+        data[manifest] = manifestfiles.getData(manifest)
+    for index, (marker, manifests) in enumerate(groups):
+        byhost = {}
+        first = len(files)
+        for manifest in manifests:
+            hostname = manifestfiles.getHost(manifest)
+            if hostname not in hostlist:
+                # not sure whose it is, leave it alone
+                files.append((manifest, marker, manifestfiles.getRequires(manifest)))
+                continue
+            if hostname not in byhost:
+                byhost[hostname] = []
+                files.append((hostname, marker, None))
+            byhost[hostname].append(manifest)
+
+        for position in range(first, len(files)):
+            name, marker, requires = files[position]
+            if name not in byhost:
+                continue
+            manifests = byhost.pop(name)
+            if len(manifests) == 1:
+                files[position] = (manifests[0], marker, manifestfiles.getRequires(manifests[0]))
+                continue
+            merged = os.path.join(basedefs.PUPPET_MANIFEST_DIR, "%s_merged%d.pp" % (name, index))
+            keys[merged] = frozenset().union(*[keys[manifest] for manifest in manifests])
+            files[position] = (merged, marker, _mergeManifests(merged, manifests, data))
+
+    manifestfiles.clear()
+    for manifest, marker, requires in files:
+        manifestfiles.addFile(manifest, marker, requires)
+        manifestfiles.addKeys(manifest, keys.get(manifest, ()))
+        manifestfiles.addData(manifest, data[manifest])
+
+def _mergeManifests(merged, manifests, data):
+    """
+    Merge manifests into merged in data and write its .map file, returns
+    the markers the merged manifest requires
+    """
+    requires = []
+    lineno = 1
+    parts = []
+    if not os.path.exists(basedefs.PUPPET_MANIFEST_DIR):
+        os.mkdir(basedefs.PUPPET_MANIFEST_DIR)
+    with open("%s.map" % merged, "w") as mapfp:
+        for manifest in manifests:
+            name = os.path.basename(manifest)
+            text = data.pop(manifest)
+            if not text.endswith("\n"):
+                text += "\n"
+            parts.append("# ==== begin %s ====\n%s# ==== end %s ====\n" % (name, text, name))
+            start = lineno + 1
+            lineno += text.count("\n") + 2
+            mapfp.write("%d %d %s\n" % (start, lineno - 2, name))
+            logging.debug("Merged %s into %s" % (name, merged))
+
+            if requires is not None:
+                if manifestfiles.getRequires(manifest) is None:
+                    requires = None
+                else:
+                    requires += manifestfiles.getRequires(manifest)
+    data[merged] = "".join(parts)
+    return requires
+
+def writePuppetManifests():
+    manifestfiles.writeFiles()
+
+# module archives kept in the local cache, the most recent first
+ARCHIVES_KEPT = 3
+
+def getModuleArchive(exclude=()):
+    """
+    Returns the path of a gzipped tar of the puppet modules and the hash
+    of the module tree it holds. Archives are cached under DIR_STATE by
+    that hash, so the modules are only archived again once they change.
+    """
+    treehash = utils.getTreeHash(MODULEDIR, exclude)
+    archivedir = os.path.join(basedefs.DIR_STATE, "archives")
+    archive = os.path.join(archivedir, "modules-%s.tar.gz" % treehash)
+    if os.path.exists(archive):
+        logging.debug("Reusing puppet module archive %s" % archive)
+        os.utime(archive, None)
+        return archive, treehash
+
+    if not os.path.isdir(archivedir):
+        os.makedirs(archivedir)
+    tmparchive = "%s.%d" % (archive, os.getpid())
+    cmd = ["tar", "--dereference", "-czf", tmparchive]
+    for name in exclude:
+        cmd += ["--exclude", name]
+    utils.execCmd(cmd + ["modules"], cwd=PUPPETDIR, failOnError=True,
+                  msg=output_messages.ERR_PUPPET_ARCHIVE % archive)
+    os.rename(tmparchive, archive)
+
+    archives = glob.glob(os.path.join(archivedir, "modules-*.tar.gz"))
+    archives.sort(key=os.path.getmtime, reverse=True)
+    for old in archives[ARCHIVES_KEPT:]:
+        logging.debug("Removing old puppet module archive %s" % old)
+        os.unlink(old)
+    return archive, treehash
+
+def _makePrivate(tarinfo):
+    tarinfo.mode &= 0700
+    return tarinfo
+
+def getHostManifests(hostname):
+    """
+    Returns the sorted names of this run's manifests for hostname
+    """
+    return sorted([os.path.basename(manifest) for manifest in manifestfiles.getHostFiles(hostname)])
+
+def getManifestArchive(hostname):
+    """
+    Returns the path of a gzipped tar of this run's manifests for
+    hostname, None if it has none. Hosts only get their own manifests,
+    the others' may hold passwords they have no business with.
+    """
+    names = getHostManifests(hostname)
+    if not names:
+        return None
+    archive = os.path.join(basedefs.VAR_DIR, "manifests-%s.tar.gz" % hostname)
+    fd = os.open(archive, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, "wb") as fp:
+        tar = tarfile.open(fileobj=fp, mode="w:gz", dereference=True)
+        try:
+            for name in names:
+                tar.add(os.path.join(basedefs.PUPPET_MANIFEST_DIR, name),
+                        arcname=os.path.join(os.path.basename(basedefs.PUPPET_MANIFEST_DIR), name),
+                        filter=_makePrivate)
+        finally:
+            tar.close()
+    return archive
+
+def getCachedModuleHosts(hosts, treehash):
+    """
+    Returns the hosts that already hold the module tree with treehash in
+    their module cache, these get it linked into VAR_DIR right away
+    """
+    cachedir = os.path.join(basedefs.REMOTE_MODULE_CACHE_DIR, treehash)
+    cached = set()
+
+    def probe(hostname):
+        server = utils.ScriptRunner(hostname)
+        server.append("if [ -d %s ]; then touch %s; mkdir -p %s; ln -sfn %s/modules %s/modules; "
+                      "echo PACKSTACK_MODULES_CACHED; fi" % (cachedir, cachedir, basedefs.VAR_DIR,
+                                                             cachedir, basedefs.VAR_DIR))
+        def found(host, stream, line):
+            if stream == "stdout" and line.strip() == "PACKSTACK_MODULES_CACHED":
+                cached.add(hostname)
+        server.addLineCallback(found)
+        return server
+    utils.HostPool(hosts).runScripts(probe).raiseOnError()
+    return cached
+
+def getModuleInstallCommand(treehash, archive="-"):
+    """
+    Returns the command extracting the module archive (stdin by default)
+    into the module cache and linking it into VAR_DIR, older trees and
+    archives in the cache are removed except for the ARCHIVES_KEPT most
+    recently used
+    """
+    cachedir = os.path.join(basedefs.REMOTE_MODULE_CACHE_DIR, treehash)
+    return ("mkdir -p %(cache)s.$$ && tar -C %(cache)s.$$ -xzf %(archive)s && "
+            "{ mv -T %(cache)s.$$ %(cache)s 2> /dev/null || rm -rf %(cache)s.$$; } && "
+            "mkdir -p %(var)s && ln -sfn %(cache)s/modules %(var)s/modules && "
+            "cd %(root)s && ls -t | grep -v '\\.' | tail -n +%(keep)d | xargs -r rm -rf && "
+            "ls -t | grep '\\.tar\\.gz$' | tail -n +%(keep)d | xargs -r rm -f" %
+            {"cache": cachedir, "archive": archive, "var": basedefs.VAR_DIR,
+             "root": basedefs.REMOTE_MODULE_CACHE_DIR, "keep": ARCHIVES_KEPT + 1})
+
+def getModuleRelayCommand(treehash, archivehash):
+    """
+    Returns the command storing the module archive read from stdin in the
+    module cache, so the host can forward it, and installing it once its
+    sha1 is checked against archivehash
+    """
+    archive = os.path.join(basedefs.REMOTE_MODULE_CACHE_DIR, "%s.tar.gz" % treehash)
+    return ("mkdir -p %(root)s && cat > %(archive)s.$$ && "
+            "{ echo '%(sha1)s  %(archive)s.'$$ | sha1sum -c --status || "
+            "{ rm -f %(archive)s.$$; echo 'Corrupted puppet module archive' >&2; exit 1; }; } && "
+            "mv -f %(archive)s.$$ %(archive)s && %(install)s" %
+            {"root": basedefs.REMOTE_MODULE_CACHE_DIR, "archive": archive, "sha1": archivehash,
+             "install": getModuleInstallCommand(treehash, archive)})
+
+def relayModules(hosts, modules, treehash, fanout):
+    """
+    Get the module archive onto hosts as a tree, we send it to fanout
+    hosts and every host that has it forwards it to up to fanout others,
+    so the number of hosts holding it grows by a factor of fanout + 1 per
+    round. Returns the hosts that couldn't be reached that way.
+    """
+    digest = hashlib.sha1()
+    with open(modules, "rb") as fp:
+        for chunk in iter(lambda: fp.read(65536), ""):
+            digest.update(chunk)
+    receive = getModuleRelayCommand(treehash, digest.hexdigest())
+    archive = os.path.join(basedefs.REMOTE_MODULE_CACHE_DIR, "%s.tar.gz" % treehash)
+
+    pending = list(hosts)
+    holders = [None]
+    failed = []
+    while pending:
+        parents = {}
+        for parent in holders:
+            for i in range(fanout):
+                if not pending:
+                    break
+                parents[pending.pop(0)] = parent
+
+        def push(hostname):
+            # runs here, reaching the parent (if any) and then hostname
+            server = utils.ScriptRunner()
+            parent = parents[hostname]
+            if parent is None:
+                server.append("%s < %s" % (utils.transport.getCommand(hostname, receive), modules))
+            else:
+                relay = "%s < %s" % (utils.transport.getRelayCommand(parent, hostname, receive), archive)
+                server.append(utils.transport.getCommand(parent, relay, forwardagent=True))
+            return server
+        logging.debug("Relaying puppet modules to %s" % ", ".join(parents))
+        result = utils.HostPool(list(parents)).runScripts(push)
+        holders += result.getSucceededHosts()
+        failed += result.getFailedHosts()
+    return failed
+
+class AppliedState(object):
+    """
+    Remembers, in basedefs.DIR_STATE, a hash of each manifest last applied
+    successfully along with the puppet modules, and a hash of the values
+    of the CONF keys the manifests depend on. In a later run only the
+    manifests whose hash changed or that depend on keys whose value
+    changed are applied, hosts with none of those are left alone.
+    """
+    def __init__(self):
+        self.manifests = {}
+        self.answers = {}
+        self.hashes = {}
+        self.stale = set()
+        self.unchanged = set()
+
+    def _getPath(self):
+        return os.path.join(basedefs.DIR_STATE, "applied.json")
+
+    def _hashValue(self, value):
+        # answers are only compared, there's no need to keep passwords
+        return hashlib.sha1(unicode(value).encode("utf-8")).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self._getPath()):
+            return
+        try:
+            with open(self._getPath()) as fp:
+                state = json.load(fp)
+            self.manifests = state["manifests"]
+            self.answers = state["answers"]
+            for key in TEMPORARY_KEYS:
+                self.answers.pop(key, None)
+        except (IOError, ValueError, KeyError, TypeError):
+            logging.debug("Failed to read %s" % self._getPath(), exc_info=True)
+            logging.warning("Ignoring unreadable applied manifest state %s" % self._getPath())
+
+    def check(self, hosts, treehash, force=False):
+        """
+        Hash the manifests of hosts for this run, returns the hosts none
+        of whose manifests need to be applied
+        """
+        changed = [key for key in self.answers
+                   if self._hashValue(controller.CONF.get(key)) != self.answers[key]]
+        affected = set(manifestfiles.getAffectedFiles(changed))
+        for hostname in hosts:
+            uptodate = True
+            for name in getHostManifests(hostname):
+                manifest = os.path.join(basedefs.PUPPET_MANIFEST_DIR, name)
+                digest = hashlib.sha1(treehash)
+                with open(manifest, "rb") as fp:
+                    digest.update(fp.read())
+                self.hashes[manifest] = digest.hexdigest()
+                if manifest in affected:
+                    logging.debug("%s depends on %s which changed" %
+                                  (name, ", ".join(sorted(manifestfiles.getKeys(manifest) & set(changed)))))
+                elif self.manifests.get(name) != self.hashes[manifest]:
+                    logging.debug("%s or the puppet modules changed" % name)
+                elif not force:
+                    continue
+                self.stale.add(manifest)
+                uptodate = False
+            if uptodate:
+                self.unchanged.add(hostname)
+        return self.unchanged
+
+    def save(self, applied, attempted):
+        """
+        Record the manifests in applied as applied with this run's inputs,
+        the other manifests in attempted are forgotten as whatever state
+        they left their host in is unknown
+        """
+        for manifest in attempted:
+            self.manifests.pop(os.path.basename(manifest), None)
+        for manifest in applied:
+            self.manifests[os.path.basename(manifest)] = self.hashes[manifest]
+            for key in manifestfiles.getKeys(manifest):
+                self.answers[key] = self._hashValue(controller.CONF.get(key))
+        path = self._getPath()
+        try:
+            if not os.path.isdir(basedefs.DIR_STATE):
+                os.makedirs(basedefs.DIR_STATE, 0700)
+            with open(path + ".tmp", "w") as fp:
+                json.dump({"manifests": self.manifests, "answers": self.answers}, fp)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            logging.warning(output_messages.ERR_PUPPET_STATE_SAVE % (path, e))
+
+appliedstate = AppliedState()
 
 def copyPuppetModules():
-    server = utils.ScriptRunner()
-    tar_opts = ""
+    exclude = []
     if platform.linux_distribution()[0] == "Fedora":
-        tar_opts += "--exclude create_resources "
-    for hostname in gethostlist(controller.CONF):
-        server.append("cd %s/puppet"%basedefs.DIR_PROJECT_DIR)
-        server.append("tar %s --dereference -czf - modules | ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null root@%s tar -C %s -xzf -"%(tar_opts, hostname, basedefs.VAR_DIR))
-        server.append("cd %s"%basedefs.PUPPET_MANIFEST_DIR)
-        server.append("tar %s --dereference -czf - ../manifests | ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null root@%s tar -C %s -xzf -"%(tar_opts, hostname, basedefs.VAR_DIR))
-    server.execute()
-
-def waitforpuppet(currently_running):
-    while currently_running:
-        for hostname, log in currently_running:
-            server = utils.ScriptRunner(hostname)
-            server.append("test -e %s"%log)
-            server.append("cat %s"%log)
-            print "Testing if puppet apply is finished : %s"%os.path.split(log)[1],
-            try:
-                # Errors are expected here if the puppet run isn't finished so we suppress their logging
-                server.execute(logerrors=False)
-                currently_running.remove((hostname,log))
-                print "OK"
-            except Exception, e:
-                # the test raises an exception if the file doesn't exist yet
-                time.sleep(3)
-                print
+        exclude.append("create_resources")
+    # the module archive is built once and sent to every host, along with
+    # an archive of the host's own manifests
+    modules, treehash = getModuleArchive(exclude)
+
+    hosts = [hostname for hostname in gethostlist(controller.CONF) if hostname not in utils.stragglers]
+    appliedstate.load()
+    unchanged = appliedstate.check(hosts, treehash, controller.CONF['CONFIG_PUPPET_FORCE_APPLY'] == 'y')
+    for hostname in sorted(unchanged):
+        print "%s is up to date, not applying its manifests" % hostname
+    hosts = [hostname for hostname in hosts if hostname not in unchanged]
+
+    cached = getCachedModuleHosts(hosts, treehash)
+    for hostname in cached:
+        logging.debug("%s already has the puppet modules, not copying them" % hostname)
+    tocopy = [hostname for hostname in hosts if hostname not in cached]
+
+    fanout = int(controller.CONF['CONFIG_PUPPET_RELAY_FANOUT'])
+    if fanout and tocopy and not utils.transport.canRelay():
+        logging.warning("Hosts can't reach each other, sending the puppet modules to every host from here")
+    elif fanout and tocopy:
+        # whatever didn't make it through the relay is sent directly
+        tocopy = relayModules(tocopy, modules, treehash, fanout)
+
+    def push(hostname):
+        # runs here, one session per host so each gets its own deadline
+        server = utils.ScriptRunner()
+        if hostname in tocopy:
+            server.append("%s < %s"%(utils.transport.getCommand(hostname, getModuleInstallCommand(treehash)), modules))
+        manifests = getManifestArchive(hostname)
+        if manifests:
+            server.append("%s < %s"%(utils.transport.getCommand(hostname, "tar -C %s -xzf -" % basedefs.VAR_DIR), manifests))
+        if not server.script:
+            return None
+        return server
+    utils.HostPool(hosts).runScripts(push).raiseOnError()
+
+# times a host's watcher may fail (e.g. dropped connection) before giving up
+WATCHER_RETRIES = 5
+
+# the watcher reports puppet's exit code on a line starting with this
+PUPPET_RC_MARKER = "PACKSTACK_PUPPET_RC="
+# puppet apply --detailed-exitcodes, 2 is success with changes made
+PUPPET_RC_OK = ("0", "2")
+
+def getPuppetWatcher(hostname, manifest, offset=0):
+    """
+    Returns a script that starts puppet applying manifest on hostname
+    (unless it was already started), then streams the run's log from byte
+    offset on as it is written and blocks until the run is finished (its
+    log is renamed into place). inotifywait is used to wake up as soon as
+    that happens if the host has it, otherwise the log is checked every
+    second. The last line the script prints is puppet's exit code after
+    PUPPET_RC_MARKER.
+    """
+    server = utils.ScriptRunner(hostname)
+    log = "%s.log" % manifest
+    inprogress = "%s_" % log
+    rcfile = "%s.rc" % manifest
+    # puppet runs detached from the session, so it carries on if the
+    # connection drops and the watcher is started again, its exit code is
+    # stored before the log is renamed
+    server.append("if [ ! -e %s ] && [ ! -e %s ]; then : > %s; rm -f %s; "
+                  "( flock %s/ps.lock puppet apply --detailed-exitcodes --verbose --evaltrace --summarize "
+                  "--modulepath %s/modules %s > %s 2>&1 < /dev/null ; echo $? > %s; mv %s %s ) "
+                  "> /dev/null 2>&1 < /dev/null & fi" % (inprogress, log, inprogress, rcfile, basedefs.VAR_DIR,
+                                                         basedefs.VAR_DIR, manifest, inprogress, rcfile, inprogress, log))
+    # the loop would fill the host's log with traces every second
+    server.append("set +x")
+    server.append("if command -v inotifywait > /dev/null; then "
+                  "wait='inotifywait -qq -t 1 -e moved_to -e create %s'; else wait='sleep 1'; fi" % os.path.dirname(log))
+    # the log keeps the same inode once renamed, so once open it can be
+    # read to the end whatever its name
+    server.append("until { exec 3< %s; } 2> /dev/null || { exec 3< %s; } 2> /dev/null; do "
+                  "$wait > /dev/null 2>&1 || true; done" % (inprogress, log))
+    server.append("head -c %d <&3 > /dev/null" % offset)
+    server.append("until [ -e %s ]; do cat <&3; $wait > /dev/null 2>&1 || true; done" % log)
+    server.append("cat <&3")
+    server.append("echo %s$(cat %s 2> /dev/null)" % (PUPPET_RC_MARKER, rcfile))
+    return server
+
+# resources and classes listed per host and fleet-wide in the timing report
+TIMINGS_LISTED = 10
+
+class PuppetTimings(object):
+    """
+    Collects how long puppet took for every resource it evaluated and for
+    compiling and applying each catalog, from the --evaltrace and
+    --summarize output of the runs' logs
+    """
+    # e.g. "Info: /Stage[main]/Nova::Compute/Package[nova-compute]: Evaluated in 3.14 seconds"
+    RESOURCE_RE = re.compile(r"^\S+: (/Stage\[[^\]]*\]/.*): Evaluated in ([\d.]+) seconds")
+    COMPILE_RE = re.compile(r"^\S+: Compiled catalog for .* in ([\d.]+) seconds", re.IGNORECASE)
+    APPLY_RE = re.compile(r"^\S+: Finished catalog run in ([\d.]+) seconds", re.IGNORECASE)
+
+    def __init__(self):
+        self.resources = {}
+        self.classes = {}
+        self.compile = {}
+        self.apply = {}
+
+    def addLine(self, hostname, manifest, line):
+        match = self.RESOURCE_RE.match(line)
+        if match:
+            resource, seconds = match.group(1), float(match.group(2))
+            self.resources[hostname, resource] = self.resources.get((hostname, resource), 0) + seconds
+            # the class is what follows the stage in the resource's path,
+            # it's empty for resources declared outside of any class
+            klass = resource.split("/")[2] or "Main"
+            self.classes[hostname, klass] = self.classes.get((hostname, klass), 0) + seconds
+            return
+        for expr, times in ((self.COMPILE_RE, self.compile), (self.APPLY_RE, self.apply)):
+            match = expr.match(line)
+            if match:
+                times[hostname, manifest] = float(match.group(1))
+
+    def _rank(self, times, hostname=None):
+        """
+        Returns the (name, seconds) of times, summed over hosts unless
+        hostname is given, slowest first
+        """
+        totals = {}
+        for (host, name), seconds in times.items():
+            if hostname is None or host == hostname:
+                totals[name] = totals.get(name, 0) + seconds
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+    def getSummary(self):
+        """
+        Returns the lines of a short report, the fleet-wide totals and
+        slowest resources
+        """
+        lines = ["Puppet spent %.2fs compiling catalogs and %.2fs applying them" %
+                 (sum(self.compile.values()), sum(self.apply.values()))]
+        for resource, seconds in self._rank(self.resources)[:5]:
+            lines.append("%10.2fs %s" % (seconds, resource))
+        return lines
+
+    def write(self, path):
+        """
+        Write the full report to path
+        """
+        hosts = sorted(set([host for host, name in self.resources.keys() + self.compile.keys() + self.apply.keys()]))
+        with open(path, "w") as fp:
+            fp.write("%s\n" % self.getSummary()[0])
+            for title, times in [("resources", self.resources), ("classes", self.classes)]:
+                fp.write("\nSlowest %s on all hosts:\n" % title)
+                for name, seconds in self._rank(times)[:TIMINGS_LISTED]:
+                    fp.write("%10.2fs %s\n" % (seconds, name))
+            for hostname in hosts:
+                fp.write("\n%s:\n" % hostname)
+                for (host, manifest), seconds in sorted(self.compile.items()):
+                    if host == hostname:
+                        fp.write("%10.2fs compiling %s, %.2fs applying it\n" %
+                                 (seconds, os.path.basename(manifest), self.apply.get((host, manifest), 0)))
+                for title, times in [("resources", self.resources), ("classes", self.classes)]:
+                    fp.write("  Slowest %s:\n" % title)
+                    for name, seconds in self._rank(times, hostname)[:TIMINGS_LISTED]:
+                        fp.write("%10.2fs %s\n" % (seconds, name))
+
+class PuppetRuns(object):
+    """
+    Applies manifests and follows their runs. Every run is a single
+    session to its host that starts puppet and then streams the run's log
+    into a local copy under the log directory as it goes, returning as
+    soon as the run is done. All the sessions are driven by one
+    ExecutionLoop, with at most HostPool.parallelism of them running at
+    once and the others queued.
+    """
+    def __init__(self):
+        self.logdir = os.path.join(basedefs.DIR_LOG, "puppet")
+        if not os.path.isdir(self.logdir):
+            os.makedirs(self.logdir)
+        self.loop = utils.ExecutionLoop(utils.HostPool.parallelism)
+        self.sessions = {}
+        self.offsets = {}
+        # paths of the local copies, they are only open while their run is
+        # being watched
+        self.livelogs = {}
+        self.openlogs = {}
+        self.failures = {}
+        self.rcs = {}
+        # (hostname, manifest) of the runs puppet failed
+        self.failed = []
+        self.timings = PuppetTimings()
+
+    def _watch(self, hostname, manifest):
+        server = getPuppetWatcher(hostname, manifest, self.offsets[hostname, manifest])
+
+        def copyLine(host, stream, line):
+            if stream != "stdout":
+                return
+            # the log may not end with a newline, so the exit code isn't
+            # necessarily at the start of the line
+            marker = line.find(PUPPET_RC_MARKER)
+            if marker >= 0:
+                self.rcs[hostname, manifest] = line[marker + len(PUPPET_RC_MARKER):].strip()
+                line = line[:marker]
+            if line:
+                livelog = self.openlogs.get((hostname, manifest))
+                if not livelog:
+                    livelog = open(self.livelogs[hostname, manifest], "a")
+                    self.openlogs[hostname, manifest] = livelog
+                livelog.write(line)
+                livelog.flush()
+                self.offsets[hostname, manifest] += len(line)
+                self.timings.addLine(hostname, manifest, line)
+        server.addLineCallback(copyLine)
+        session = utils.ScriptSession(server, timeout=utils.HostPool.deadline)
+        self.sessions[session] = (hostname, manifest)
+        self.loop.add(session)
+
+    def apply(self, hostname, manifest):
+        print "Applying "+ manifest
+        self.offsets[hostname, manifest] = 0
+        self.livelogs[hostname, manifest] = os.path.join(self.logdir, "%s.log" % os.path.basename(manifest))
+        open(self.livelogs[hostname, manifest], "w").close()
+        logging.debug("Copying the puppet log of %s from %s to %s" % (manifest, hostname,
+                                                                     self.livelogs[hostname, manifest]))
+        self._watch(hostname, manifest)
+
+    def _closeLog(self, hostname, manifest):
+        livelog = self.openlogs.pop((hostname, manifest), None)
+        if livelog:
+            livelog.close()
+
+    def isEmpty(self):
+        return self.loop.isEmpty()
+
+    def wait(self):
+        """
+        Wait for runs to finish, returns the list of (hostname, manifest)
+        of the runs that finished successfully and of those that didn't in
+        time, failed runs are added to failed
+        """
+        finished = []
+        timedout = []
+        failed = []
+        while not self.loop.isEmpty() and not finished and not timedout and not failed:
+            for session in self.loop.poll():
+                hostname, manifest = self.sessions.pop(session)
+                print "Testing if puppet apply is finished : %s.log"%os.path.split(manifest)[1],
+                if isinstance(session.error, utils.ScriptTimeoutException):
+                    print utils.getColoredText("TIMEOUT", basedefs.RED)
+                    utils.stragglers.add(hostname)
+                    timedout.append((hostname, manifest))
+                elif session.error:
+                    print utils.getColoredText("RETRYING", basedefs.YELLOW)
+                    self.failures[hostname, manifest] = self.failures.get((hostname, manifest), 0) + 1
+                    if self.failures[hostname, manifest] > WATCHER_RETRIES:
+                        raise session.error
+                    self._watch(hostname, manifest)
+                elif self.rcs.get((hostname, manifest)) not in PUPPET_RC_OK:
+                    print utils.getColoredText("ERROR", basedefs.RED)
+                    failed.append((hostname, manifest))
+                else:
+                    print "OK"
+                    finished.append((hostname, manifest))
+                self._closeLog(hostname, manifest)
+        self.failed += failed
+        return finished, timedout
+
+    def close(self):
+        for livelog in self.openlogs.values():
+            livelog.close()
+        self.openlogs = {}
+
+def getManifestGraph():
+    """
+    Returns the (hostname, manifest) pairs to apply in order, and for each
+    the set of pairs it has to wait for. Manifests are grouped by marker
+    as they were added, a manifest waits for every manifest of the groups
+    before its own, or if it lists the markers it requires, only for the
+    manifests with those markers and those before it on its own host.
+    """
+    hosts = set(gethostlist(controller.CONF))
+    nodes = []
+    dependencies = {}
+    for phase, (marker, manifests) in enumerate(manifestfiles.getPhases()):
+        # shared by the manifests waiting for everything before them
+        before = frozenset(nodes)
+        for manifest in manifests:
+            hostname = manifestfiles.getHost(manifest)
+            if hostname not in hosts: continue
+            node = (hostname, manifest)
+            requires = manifestfiles.getRequires(manifest)
+            if requires is None:
+                dependencies[node] = before
+            else:
+                dependencies[node] = set()
+                others = manifestfiles.getHostFiles(hostname)
+                for required in requires:
+                    others += manifestfiles.getMarkerFiles(required)
+                for other in others:
+                    if manifestfiles.getPhase(other) < phase and manifestfiles.getHost(other) in hosts:
+                        dependencies[node].add((manifestfiles.getHost(other), other))
+            nodes.append(node)
+    return nodes, dependencies
 
 def applyPuppetManifest():
     print
-    currently_running = []
-    lastmarker = None
-    for manifest, marker in manifestfiles.getFiles():
-        # if the marker has changed then we don't want to proceed until
-        # all of the previous puppet runs have finished
-        if lastmarker != None and lastmarker != marker:
-            waitforpuppet(currently_running)
-        lastmarker = marker
-        
-        for hostname in gethostlist(controller.CONF):
-            if "/%s_"%hostname not in manifest: continue
-
-            print "Applying "+ manifest
-            server = utils.ScriptRunner(hostname)
-
-            logfile = "%s.log"%manifest
-            currently_running.append((hostname, logfile))
-            command = "( flock %s/ps.lock puppet apply --modulepath %s/modules %s > %s_ 2>&1 < /dev/null ; mv %s_ %s ) > /dev/null 2>&1 < /dev/null &"%(basedefs.VAR_DIR, basedefs.VAR_DIR, manifest, logfile, logfile, logfile)
-            server.append(command)
-            server.execute()
-
-    # wait for outstanding puppet runs befor exiting
-    waitforpuppet(currently_running)
+    nodes, dependencies = getManifestGraph()
+    # manifests found up to date count as applied already, those of hosts
+    # that weren't checked (stragglers) don't
+    done = set([node for node in nodes if node[1] in appliedstate.hashes and node[1] not in appliedstate.stale])
+    nodes = [node for node in nodes if node not in done]
+    attempted = set([manifest for hostname, manifest in nodes])
+    runs = PuppetRuns()
+    try:
+        while nodes or not runs.isEmpty():
+            # start everything whose dependencies are all done, in order
+            for node in list(nodes):
+                hostname, manifest = node
+                if hostname in utils.stragglers or not dependencies[node] <= done:
+                    continue
+                nodes.remove(node)
+                runs.apply(hostname, manifest)
+            if runs.isEmpty():
+                break
+            finished, timedout = runs.wait()
+            done.update(finished)
+    finally:
+        runs.close()
+        appliedstate.save([manifest for hostname, manifest in done if manifest in attempted], attempted)
+
+    report = os.path.join(runs.logdir, "timings.log")
+    runs.timings.write(report)
+    print
+    for line in runs.timings.getSummary():
+        print line
+    controller.MESSAGES.append(output_messages.INFO_PUPPET_TIMINGS % report)
+
+    for hostname, manifest in nodes:
+        logging.warning("Not applying %s, %s or a host it depends on missed a deadline or failed" % (manifest, hostname))
+
+    if runs.failed:
+        raise Exception("\n".join([output_messages.ERR_PUPPET_APPLY % (os.path.basename(manifest), hostname,
+                                                                      runs.rcs.get((hostname, manifest)) or "unknown",
+                                                                      runs.livelogs[hostname, manifest])
+                                   for hostname, manifest in runs.failed]))
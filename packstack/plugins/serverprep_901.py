@@ -96,7 +96,7 @@ def initSequences(controller):
 
 
 def serverprep():
-    for hostname in gethostlist(controller.CONF):
+    def prepare(hostname):
         if '/' in hostname:
             hostname = hostname.split('/')[0]
         server = utils.ScriptRunner(hostname)
@@ -123,4 +123,6 @@ def serverprep():
             server.append("yum clean all")
             server.append("yum-config-manager --enable rhel-server-ost-6-folsom-rpms")
 
-        server.execute()
+        return server
+
+    utils.HostPool(gethostlist(controller.CONF)).runScripts(prepare).raiseOnError()
@@ -62,7 +62,7 @@ def installKeys():
     with open(controller.CONF["CONFIG_SSH_KEY"]) as fp:
         sshkeydata = fp.read().strip()
 
-    for hostname in gethostlist(controller.CONF):
+    def installKey(hostname):
         if '/' in hostname:
             hostname = hostname.split('/')[0]
         server = utils.ScriptRunner(hostname)
@@ -70,5 +70,6 @@ def installKeys():
         server.append("mkdir -p ~/.ssh")
         server.append("grep '%s' ~/.ssh/authorized_keys > /dev/null 2>&1 || echo %s > ~/.ssh/authorized_keys"%(sshkeydata, sshkeydata))
         server.append("restorecon -r ~/.ssh")
-        server.execute()
+        return server
 
+    utils.HostPool(gethostlist(controller.CONF)).runScripts(installKey).raiseOnError()
@@ -148,7 +148,8 @@ def createbuildermanifest():
         manifestdata = manifestdata + '\n@@ring_container_device { "%s:6001/%s":\n zone        => %s,\n weight      => 10, }'%(getIP(host), devicename, zone)
         manifestdata = manifestdata + '\n@@ring_account_device { "%s:6002/%s":\n zone        => %s,\n weight      => 10, }'%(getIP(host), devicename, zone)
 
-    appendManifestFile(manifestfile, manifestdata, 'swiftbuilder')
+    appendManifestFile(manifestfile, manifestdata, 'swiftbuilder',
+                       keys=['CONFIG_SWIFT_STORAGE_HOSTS', 'CONFIG_SWIFT_STORAGE_ZONES'])
 
 def createproxymanifest():
     manifestfile = "%s_swift.pp"%controller.CONF['CONFIG_SWIFT_PROXY_HOSTS']
@@ -156,7 +157,8 @@ def createproxymanifest():
     # If the proxy server is also a storage server then swift::ringsync will be included for the storage server
     if controller.CONF['CONFIG_SWIFT_PROXY_HOSTS'] not in controller.CONF["CONFIG_SWIFT_STORAGE_HOSTS"].split(","):
         manifestdata += 'swift::ringsync{["account","container","object"]:\n    ring_server => "%s"\n}'%controller.CONF['CONFIG_SWIFT_BUILDER_HOST']
-    appendManifestFile(manifestfile, manifestdata)
+    appendManifestFile(manifestfile, manifestdata,
+                       keys=['CONFIG_SWIFT_PROXY_HOSTS', 'CONFIG_SWIFT_STORAGE_HOSTS', 'CONFIG_SWIFT_BUILDER_HOST'])
 
 def createstoragemanifest():
 
@@ -165,7 +167,8 @@ def createstoragemanifest():
         controller.CONF["CONFIG_SWIFT_STORAGE_CURRENT"] = getIP(host)
         manifestfile = "%s_swift.pp"%host
         manifestdata = getManifestTemplate("swift_storage.pp")
-        appendManifestFile(manifestfile, manifestdata)
+        # storage hosts only need the rings
+        appendManifestFile(manifestfile, manifestdata, requires=['swiftbuilder'])
 
     # this need to happen once per storage device
     for device in devices:
@@ -175,7 +178,7 @@ def createstoragemanifest():
        
         server = utils.ScriptRunner(host)
         validate.r_validateDevice(server, device)
-        server.execute()
+        server.execute(defer=True)
 
         manifestfile = "%s_swift.pp"%host
         if device:
@@ -183,10 +186,12 @@ def createstoragemanifest():
         else:
             controller.CONF["SWIFT_STORAGE_DEVICES"] = "'%s'"%devicename
             manifestdata = "\n" + getManifestTemplate("swift_loopback.pp")
-        appendManifestFile(manifestfile, manifestdata)
+        # the devices are local to the host
+        appendManifestFile(manifestfile, manifestdata, requires=[],
+                           keys=['CONFIG_SWIFT_STORAGE_HOSTS', 'CONFIG_SWIFT_STORAGE_FSTYPE'])
 
 def createcommonmanifest():
     for manifestfile, marker in manifestfiles.getFiles():
         if manifestfile.endswith("_swift.pp"):
             data = getManifestTemplate("swift_common.pp")
-            appendManifestFile(os.path.split(manifestfile)[1], data)
+            appendManifestFile(os.path.split(manifestfile)[1], data, requires=[])
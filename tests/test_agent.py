@@ -0,0 +1,116 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from packstack.installer import agent, transports
+import packstack.installer.common_utils as utils
+
+from test_base import PackstackTestCase
+
+class NoPythonTransport(transports.LocalTransport):
+    """
+    Runs the commands of every host locally with only the executables in
+    path available
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def getArgs(self, host, command):
+        return ["env", "PATH=%s" % self.path, "/bin/bash", "-c", command]
+
+class AgentProtocolTestCase(PackstackTestCase):
+    def setUp(self):
+        PackstackTestCase.setUp(self)
+        self.proc = subprocess.Popen([sys.executable, utils.AGENT_SOURCE], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, close_fds=True)
+
+    def tearDown(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        PackstackTestCase.tearDown(self)
+
+    def call(self, request):
+        """
+        Send request, returns its response and the output frames sent
+        before it
+        """
+        agent.writeFrame(self.proc.stdin, request)
+        output = []
+        while True:
+            response = agent.readFrame(self.proc.stdout)
+            if "stream" not in response:
+                return response, output
+            self.assertEqual(response["id"], request.get("id"))
+            output.append((response["stream"], response["data"]))
+
+    def test_frames(self):
+        response, output = self.call({"op": "run", "id": 1, "script": "echo out; echo err >&2; exit 3"})
+        self.assertEqual(response["id"], 1)
+        self.assertEqual(response["rc"], 3)
+        # output is streamed in frames of its own before the response
+        self.assertEqual("".join([data for stream, data in output if stream == "stdout"]), "out\n")
+        self.assertTrue("err\n" in "".join([data for stream, data in output if stream == "stderr"]))
+        # frames are length prefixed, so data can hold anything
+        data = "two\nlines \xc3\xa9\n".decode("utf-8")
+        script = "cat <<'EOF'\n%sEOF" % data
+        output = self.call({"op": "run", "script": script})[1]
+        self.assertEqual("".join([data for stream, data in output if stream == "stdout"]), data)
+
+    def test_errors(self):
+        response = self.call({"op": "bogus", "id": 2})[0]
+        self.assertEqual((response["id"], response["rc"]), (2, 255))
+        self.assertTrue("error" in response)
+        # the agent carries on after a failed request
+        self.assertEqual(self.call({"op": "ping"})[0]["rc"], 0)
+        agent.writeFrame(self.proc.stdin, {"op": "exit"})
+        self.assertEqual(self.proc.wait(), 0)
+
+class RemoteAgentTestCase(PackstackTestCase):
+    def setUp(self):
+        PackstackTestCase.setUp(self)
+        self.agents, self.enabled = utils.agents, utils.AgentPool.enabled
+        utils.agents = utils.AgentPool()
+        utils.AgentPool.enabled = True
+
+    def tearDown(self):
+        utils.agents.closeAll()
+        utils.agents, utils.AgentPool.enabled = self.agents, self.enabled
+        PackstackTestCase.tearDown(self)
+
+    def test_agent(self):
+        remote = utils.agents.get("hA")
+        self.assertTrue(remote is not None)
+        self.assertTrue(utils.agents.get("hA") is remote)
+        capture = utils.OutputCapture("hA")
+        self.assertEqual(remote.call("run", onoutput=capture.feed, script="echo hello; exit 2")["rc"], 2)
+        capture.close()
+        self.assertEqual(capture.getTail("stdout"), "hello\n")
+
+    def test_execute(self):
+        server = utils.ScriptRunner("hA")
+        server.append("touch %s/ran" % self.tempdir)
+        server.execute()
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, "ran")))
+        self.assertTrue(utils.agents.agents["hA"].proc is not None)
+        server = utils.ScriptRunner("hA")
+        server.append("false")
+        self.assertRaises(Exception, server.execute, logerrors=False)
+
+    def test_fallback(self):
+        # without python on the host the agent can't start, scripts are
+        # run over plain ssh sessions instead
+        bindir = os.path.join(self.tempdir, "bin")
+        os.mkdir(bindir)
+        os.symlink("/bin/bash", os.path.join(bindir, "bash"))
+        utils.transport = NoPythonTransport(bindir)
+        self.assertEqual(utils.agents.get("hA"), None)
+        self.assertEqual(utils.agents.agents, {"hA": None})
+        server = utils.ScriptRunner("hA")
+        server.append("echo ran > %s/ran" % self.tempdir)
+        server.execute()
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, "ran")))
+
+if __name__ == "__main__":
+    unittest.main()
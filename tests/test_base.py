@@ -0,0 +1,47 @@
+"""
+Common setup of the packstack unit tests, run them from the top of the
+source tree with
+
+    python -m unittest discover tests
+"""
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from packstack.installer import basedefs, transports
+import packstack.installer.common_utils as utils
+from packstack.installer.setup_controller import Controller
+
+class PackstackTestCase(unittest.TestCase):
+    """
+    Points the installer's directories at a temporary directory, runs the
+    scripts of every host locally and starts each test with an empty CONF
+    and no stragglers. Logging is turned off, tests check the errors they
+    expect themselves.
+    """
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.tempdir = tempfile.mkdtemp(prefix="packstack-test-")
+        self.saved = {}
+        for name in ("VAR_DIR", "DIR_LOG", "PUPPET_MANIFEST_DIR"):
+            self.saved[name] = getattr(basedefs, name)
+        basedefs.VAR_DIR = os.path.join(self.tempdir, "var")
+        basedefs.DIR_LOG = basedefs.VAR_DIR
+        basedefs.PUPPET_MANIFEST_DIR = os.path.join(basedefs.VAR_DIR, "manifests")
+        os.makedirs(basedefs.PUPPET_MANIFEST_DIR)
+        self.transport = utils.transport
+        utils.transport = transports.LocalTransport()
+        utils.stragglers.clear()
+        self.CONF = Controller().CONF
+        self.CONF.clear()
+
+    def tearDown(self):
+        self.CONF.clear()
+        utils.stragglers.clear()
+        utils.transport = self.transport
+        for name, value in self.saved.items():
+            setattr(basedefs, name, value)
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+        logging.disable(logging.NOTSET)
@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+import unittest
+
+import packstack.installer.common_utils as utils
+
+from test_base import PackstackTestCase
+
+def getScript(host, *lines):
+    server = utils.ScriptRunner(host)
+    for line in lines:
+        server.append(line)
+    return server
+
+class ExecutionLoopTestCase(PackstackTestCase):
+    def test_run(self):
+        loop = utils.ExecutionLoop()
+        output = []
+        sessions = []
+        for name in ("A", "B", "C"):
+            server = getScript(None, "echo hello from %s" % name)
+            server.addLineCallback(lambda host, stream, line: stream == "stdout" and output.append(line))
+            session = utils.ScriptSession(server)
+            loop.add(session)
+            sessions.append(session)
+        finished = loop.run()
+        self.assertEqual(set(finished), set(sessions))
+        self.assertTrue(loop.isEmpty())
+        for session in sessions:
+            self.assertEqual(session.returncode, 0)
+            self.assertEqual(session.error, None)
+        self.assertEqual(sorted(output), ["hello from A\n", "hello from B\n", "hello from C\n"])
+
+    def test_failure(self):
+        loop = utils.ExecutionLoop()
+        session = utils.ScriptSession(getScript(None, "echo oops >&2", "exit 3", "echo never"))
+        loop.add(session)
+        loop.run()
+        self.assertEqual(session.returncode, 3)
+        self.assertRaises(Exception, session.check)
+        self.assertTrue("oops\n" in session.capture.getTail("stderr"))
+        self.assertEqual(session.capture.getTail("stdout"), "")
+
+    def test_large_script(self):
+        # more than a pipe can hold both ways
+        lines = ["echo %s" % ("x" * 100)] * 2000
+        loop = utils.ExecutionLoop()
+        session = utils.ScriptSession(getScript(None, *lines))
+        loop.add(session)
+        loop.run()
+        session.check()
+        self.assertEqual(session.capture.getTail("stdout").splitlines()[-1], "x" * 100)
+
+    def test_timeout(self):
+        loop = utils.ExecutionLoop()
+        slow = utils.ScriptSession(getScript(None, "sleep 30"), timeout=1)
+        fast = utils.ScriptSession(getScript(None, "true"), timeout=1)
+        loop.add(slow)
+        loop.add(fast)
+        start = time.time()
+        loop.run()
+        self.assertTrue(time.time() - start < 10)
+        self.assertTrue(isinstance(slow.error, utils.ScriptTimeoutException))
+        self.assertRaises(utils.ScriptTimeoutException, slow.check)
+        self.assertEqual(fast.error, None)
+        self.assertEqual(fast.returncode, 0)
+
+    def test_limit(self):
+        # sessions started as others finish get the fd numbers they freed
+        loop = utils.ExecutionLoop(2)
+        for i in range(5):
+            loop.add(utils.ScriptSession(getScript(None, "sleep 0.1")))
+        finished = []
+        while not loop.isEmpty():
+            finished.extend(loop.poll())
+            self.assertTrue(len(loop.running) <= 2)
+        self.assertEqual(len(finished), 5)
+
+class HostPoolTestCase(PackstackTestCase):
+    def test_run(self):
+        def install(host, suffix):
+            if host == "hB":
+                raise Exception("no route to %s" % host)
+            return host + suffix
+        result = utils.HostPool(["hA", "hB", "hC"]).run(install, "-done")
+        self.assertEqual(result.results, {"hA": "hA-done", "hC": "hC-done"})
+        self.assertEqual(result.getSucceededHosts(), ["hA", "hC"])
+        self.assertEqual(result.getFailedHosts(), ["hB"])
+        self.assertEqual(str(result.errors["hB"]), "no route to hB")
+        self.assertRaises(Exception, result.raiseOnError)
+
+    def test_runScripts(self):
+        # the scripts are run locally, each stands in for its host's
+        def build(host):
+            if host == "hC":
+                return None
+            if host == "hB":
+                return getScript(None, "exit 4")
+            return getScript(None, "echo %s > %s/%s" % (host, self.tempdir, host))
+        result = utils.HostPool(["hA", "hB", "hC"]).runScripts(build, logerrors=False)
+        self.assertEqual(result.getSucceededHosts(), ["hA", "hC"])
+        self.assertEqual(result.results, {"hA": 0, "hC": None})
+        self.assertEqual(result.getFailedHosts(), ["hB"])
+        self.assertRaises(Exception, result.raiseOnError)
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, "hA")))
+
+    def test_runScripts_stragglers(self):
+        def build(host):
+            if host == "hB":
+                return getScript(None, "sleep 30")
+            return getScript(None, "true")
+        start = time.time()
+        result = utils.HostPool(["hA", "hB", "hC"], deadline=1).runScripts(build, logerrors=False)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(result.getSucceededHosts(), ["hA", "hC"])
+        self.assertEqual(result.getStragglers(), ["hB"])
+        self.assertEqual(result.getFailedHosts(), [])
+        # stragglers don't fail the run
+        result.raiseOnError()
+        self.assertEqual(utils.stragglers, set(["hB"]))
+
+        # and are left out of the following runs
+        built = []
+        result = utils.HostPool(["hA", "hB"]).runScripts(lambda host: built.append(host) or getScript(None, "true"))
+        self.assertEqual(built, ["hA"])
+        self.assertEqual(result.skipped, ["hB"])
+        self.assertEqual(result.getSucceededHosts(), ["hA"])
+
+    def test_run_stragglers(self):
+        # the deadline of run() is for all of a host's scripts together
+        def install(host):
+            delay = host == "hB" and 30 or 0.5
+            getScript(None, "sleep %s" % delay).execute(logerrors=False)
+            getScript(None, "sleep %s" % delay).execute(logerrors=False)
+            return host
+        start = time.time()
+        result = utils.HostPool(["hA", "hB"], deadline=2).run(install)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(result.results, {"hA": "hA"})
+        self.assertEqual(result.getStragglers(), ["hB"])
+        self.assertEqual(utils.stragglers, set(["hB"]))
+
+    def test_parallelism(self):
+        lock = threading.Lock()
+        running = []
+        highest = []
+        def install(host):
+            with lock:
+                running.append(host)
+                highest.append(len(running))
+            time.sleep(0.1)
+            with lock:
+                running.remove(host)
+        result = utils.HostPool(["hA", "hB", "hC", "hD", "hE"], parallelism=2).run(install)
+        result.raiseOnError()
+        self.assertEqual(len(result.getSucceededHosts()), 5)
+        self.assertEqual(max(highest), 2)
+
+class OutputCaptureTestCase(PackstackTestCase):
+    def test_feed(self):
+        lines = []
+        capture = utils.OutputCapture("hA", [lambda host, stream, line: lines.append((host, stream, line))])
+        capture.writeHeader("echo one")
+        capture.feed("stdout", "one\ntw")
+        capture.feed("stderr", "warning\n")
+        capture.feed("stdout", "o\nthr")
+        self.assertEqual(lines, [("hA", "stdout", "one\n"), ("hA", "stderr", "warning\n"),
+                                 ("hA", "stdout", "two\n")])
+        capture.close()
+        # the last line is passed on without making up a newline for it
+        self.assertEqual(lines[-1], ("hA", "stdout", "thr"))
+        self.assertEqual(capture.getTail("stdout"), "one\ntwo\nthr")
+        self.assertEqual(capture.getTail("stderr"), "warning\n")
+        with open(os.path.join(self.tempdir, "var", "hosts", "hA.log")) as fp:
+            log = fp.read()
+        self.assertTrue(log.startswith("# ============ "))
+        self.assertTrue(log.endswith("stdout: one\nstderr: warning\nstdout: two\nstdout: thr\n"))
+
+    def test_tail(self):
+        capture = utils.OutputCapture(None)
+        capture.feed("stdout", "".join(["%d\n" % i for i in range(1000)]))
+        capture.close()
+        tail = capture.getTail("stdout").splitlines()
+        self.assertEqual(len(tail), utils.OutputCapture.taillines)
+        self.assertEqual(tail[-1], "999")
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, "var", "hosts", "localhost.log")))
+
+class DeferredQueueTestCase(PackstackTestCase):
+    def test_flush(self):
+        queue = utils.DeferredQueue()
+        first = getScript(None, "echo one", "echo warning >&2")
+        lines = []
+        first.addLineCallback(lambda host, stream, line: lines.append((stream, line)))
+        second = getScript(None, "echo two", "false", "echo never")
+        second.errmsg = "second failed"
+        third = getScript(None, "printf three")
+        fourth = getScript(None, "echo four")
+        fragments = [queue.add(server) for server in (first, second, third, fourth)]
+
+        try:
+            queue.flush()
+        except Exception as e:
+            self.assertEqual(str(e), "second failed")
+        else:
+            self.fail("the failing fragment wasn't reported")
+
+        # one failing fragment doesn't stop the others
+        self.assertEqual([fragment.returncode for fragment in fragments], [0, 1, 0, 0])
+        self.assertEqual(fragments[0].getTail("stdout"), "one\n")
+        self.assertEqual(fragments[1].getTail("stdout"), "two\n")
+        # like a script run on its own, without a newline after its last line
+        self.assertEqual(fragments[2].getTail("stdout"), "three")
+        self.assertEqual(fragments[3].getTail("stdout"), "four\n")
+        self.assertTrue("warning" in fragments[0].getTail("stderr").splitlines())
+        self.assertFalse("warning" in fragments[3].getTail("stderr").splitlines())
+        self.assertEqual([line for stream, line in lines if stream == "stdout"], ["one\n"])
+        # bash -x traces the fragments' commands, but none of the wrapper's
+        for fragment in fragments:
+            for stream in ("stdout", "stderr"):
+                tail = fragment.getTail(stream)
+                self.assertFalse(utils.FRAGMENT_MARKER in tail)
+                self.assertFalse("rc=" in tail)
+                self.assertFalse("set +x" in tail)
+        self.assertTrue("+ echo one" in fragments[0].getTail("stderr").splitlines())
+        # the queue is empty once flushed
+        self.assertEqual(queue.hosts, [])
+        queue.flush()
+
+class TemplateTestCase(PackstackTestCase):
+    def writeTemplate(self, text):
+        path = os.path.join(self.tempdir, "test.pp")
+        with open(path, "w") as fp:
+            fp.write(text)
+        return path
+
+    def test_render(self):
+        text = "a %(NAME)s b %(COUNT)03d 100%% %(NAME)r\n"
+        values = {"NAME": "x", "COUNT": 7, "UNUSED": "y"}
+        template = utils.Template(self.writeTemplate(text))
+        self.assertEqual(template.keys, frozenset(["NAME", "COUNT"]))
+        self.assertEqual(template.render(values), text % values)
+        self.assertRaises(KeyError, template.render, {"NAME": "x"})
+
+    def test_no_key(self):
+        path = self.writeTemplate("a %s b")
+        self.assertRaises(TypeError, utils.Template, path)
+
+    def test_cache(self):
+        cache = utils.TemplateCache()
+        path = self.writeTemplate("%(A)s")
+        template = cache.get(path)
+        self.assertTrue(cache.get(path) is template)
+        # a modified template is parsed again
+        self.writeTemplate("%(B)s")
+        os.utime(path, (template.mtime + 10, template.mtime + 10))
+        self.assertEqual(cache.get(path).keys, frozenset(["B"]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import unittest
+
+from packstack.installer import basedefs
+from packstack.modules import ospluginutils
+from packstack.modules.ospluginutils import HostInventory, ManifestFiles, getHostInventory
+
+from test_base import PackstackTestCase
+
+def getManifest(name):
+    return os.path.join(basedefs.PUPPET_MANIFEST_DIR, name)
+
+class ManifestFilesTestCase(PackstackTestCase):
+    def setUp(self):
+        PackstackTestCase.setUp(self)
+        self.CONF.update({"CONFIG_MYSQL_HOST": "hA", "CONFIG_NOVA_COMPUTE_HOSTS": "hB"})
+        self.manifests = ManifestFiles()
+
+    def test_indexes(self):
+        files = [(getManifest("hA_mysql.pp"), "pre"),
+                 (getManifest("hB_prescript.pp"), "pre"),
+                 (getManifest("hA_keystone.pp"), "keystone"),
+                 (getManifest("hB_nova.pp"), "nova"),
+                 (getManifest("hA_nova.pp"), "nova"),
+                 (getManifest("hB_postscript.pp"), "pre")]
+        for filename, marker in files:
+            self.manifests.addFile(filename, marker)
+        self.manifests.addFile(files[3][0], "nova")
+        self.assertEqual(self.manifests.getFiles(), files)
+        # the last "pre" manifest starts a phase of its own
+        self.assertEqual(self.manifests.getPhases(),
+                         [("pre", [files[0][0], files[1][0]]),
+                          ("keystone", [files[2][0]]),
+                          ("nova", [files[3][0], files[4][0]]),
+                          ("pre", [files[5][0]])])
+        self.assertEqual([self.manifests.getPhase(f) for f, m in files], [0, 0, 1, 2, 2, 3])
+        self.assertEqual(self.manifests.getHost(files[1][0]), "hB")
+        self.assertEqual(self.manifests.getHostFiles("hA"), [files[0][0], files[2][0], files[4][0]])
+        self.assertEqual(self.manifests.getHostFiles("hB", 2), [files[3][0]])
+        self.assertEqual(self.manifests.getHostFiles("hC"), [])
+        self.assertEqual(self.manifests.getMarkerFiles("pre"), [files[0][0], files[1][0], files[5][0]])
+        self.manifests.clear()
+        self.assertEqual(self.manifests.getPhases(), [])
+        self.assertEqual(self.manifests.getHostFiles("hA"), [])
+
+    def test_getHost(self):
+        self.CONF["CONFIG_SWIFT_STORAGE_HOSTS"] = "my_host,my"
+        self.assertEqual(self.manifests.getHost(getManifest("hA_mysql.pp")), "hA")
+        self.assertEqual(self.manifests.getHost(getManifest("my_host_nova.pp")), "my_host")
+        self.assertEqual(self.manifests.getHost(getManifest("my_host_nova_common.pp")), "my_host")
+        self.assertEqual(self.manifests.getHost(getManifest("my_nova.pp")), "my")
+        # unknown hosts are taken up to the first "_"
+        self.assertEqual(self.manifests.getHost(getManifest("hX_nova_common.pp")), "hX")
+
+    def test_requires(self):
+        filename = getManifest("hB_nova.pp")
+        self.manifests.addFile(filename, "nova", ["pre"])
+        self.assertEqual(self.manifests.getRequires(filename), ["pre"])
+        # the markers of every part are required
+        self.manifests.addFile(filename, "nova", ["novaapi", "pre"])
+        self.assertEqual(self.manifests.getRequires(filename), ["pre", "novaapi"])
+        # a part waiting for everything before it makes the whole file wait
+        self.manifests.addFile(filename, "nova")
+        self.assertEqual(self.manifests.getRequires(filename), None)
+        self.manifests.addFile(filename, "nova", ["pre"])
+        self.assertEqual(self.manifests.getRequires(filename), None)
+        self.assertEqual(self.manifests.getFiles(), [(filename, "nova")])
+
+class AppendManifestFileTestCase(PackstackTestCase):
+    def setUp(self):
+        PackstackTestCase.setUp(self)
+        self.CONF.update({"CONFIG_MYSQL_HOST": "hA", "CONFIG_NOVA_COMPUTE_HOSTS": "hA,hB"})
+        self.templatedir = ospluginutils.PUPPET_TEMPLATE_DIR
+        ospluginutils.PUPPET_TEMPLATE_DIR = self.tempdir
+        ospluginutils.manifestfiles.clear()
+        del ospluginutils._rendered[:]
+        for name, text in (("mysql.pp", "mysql %(CONFIG_MYSQL_HOST)s\n"),
+                           ("compute.pp", "compute %(CONFIG_NOVA_COMPUTE_HOST)s\n")):
+            with open(os.path.join(self.tempdir, name), "w") as fp:
+                fp.write(text)
+
+    def tearDown(self):
+        ospluginutils.manifestfiles.clear()
+        ospluginutils.PUPPET_TEMPLATE_DIR = self.templatedir
+        PackstackTestCase.tearDown(self)
+
+    def test_keys(self):
+        manifests = ospluginutils.manifestfiles
+        self.assertEqual(ospluginutils.getTemplateKeys("mysql.pp"), frozenset(["CONFIG_MYSQL_HOST"]))
+        data = ospluginutils.getManifestTemplate("mysql.pp")
+        self.assertEqual(data, "mysql hA\n")
+        ospluginutils.appendManifestFile("hA_mysql.pp", data, "pre", keys=["CONFIG_MYSQL_PW"])
+        self.assertEqual(manifests.getKeys(getManifest("hA_mysql.pp")),
+                         frozenset(["CONFIG_MYSQL_HOST", "CONFIG_MYSQL_PW"]))
+        # per host keys count as the answer they come from
+        for host in ("hA", "hB"):
+            self.CONF["CONFIG_NOVA_COMPUTE_HOST"] = host
+            data = ospluginutils.getManifestTemplate("compute.pp")
+            ospluginutils.appendManifestFile("%s_nova.pp" % host, data, "nova")
+        self.assertEqual(manifests.getKeys(getManifest("hB_nova.pp")), frozenset(["CONFIG_NOVA_COMPUTE_HOSTS"]))
+        self.assertEqual(manifests.getData(getManifest("hB_nova.pp")), "\ncompute hB\n")
+        # templates only count for the manifest their output was appended to
+        ospluginutils.getManifestTemplate("mysql.pp")
+        ospluginutils.appendManifestFile("hB_other.pp", "other\n", "nova")
+        self.assertEqual(manifests.getKeys(getManifest("hB_other.pp")), frozenset())
+        ospluginutils.appendManifestFile("hB_next.pp", "next\n", "nova")
+        self.assertEqual(manifests.getKeys(getManifest("hB_next.pp")), frozenset())
+
+        self.assertEqual(ospluginutils.getAffectedManifests(["CONFIG_MYSQL_PW"]),
+                         [("hA", getManifest("hA_mysql.pp"))])
+        self.assertEqual(sorted(ospluginutils.getAffectedManifests(["CONFIG_NOVA_COMPUTE_HOSTS", "OTHER"])),
+                         [("hA", getManifest("hA_nova.pp")), ("hB", getManifest("hB_nova.pp"))])
+
+class HostInventoryTestCase(PackstackTestCase):
+    def test_inventory(self):
+        self.CONF.update({"CONFIG_MYSQL_HOST": "hA",
+                          "CONFIG_SWIFT_STORAGE_HOSTS": "hB/sdb, hB/sdc,hA",
+                          "CONFIG_MYSQL_PW": "secret"})
+        inventory = getHostInventory(self.CONF)
+        self.assertEqual(sorted(inventory.getHosts()), ["hA", "hB"])
+        self.assertEqual(sorted(inventory.getRoles("hA")), ["CONFIG_MYSQL_HOST", "CONFIG_SWIFT_STORAGE_HOSTS"])
+        self.assertEqual(inventory.getDevices("hB"), ["sdb", "sdc"])
+        self.assertEqual(inventory.getRoles("hC"), [])
+        # it is kept until the hosts change
+        self.assertTrue(getHostInventory(self.CONF) is inventory)
+        self.CONF["CONFIG_MYSQL_PW"] = "other"
+        self.assertTrue(getHostInventory(self.CONF) is inventory)
+        self.CONF["CONFIG_MYSQL_HOST"] = "hC"
+        self.assertEqual(sorted(ospluginutils.gethostlist(self.CONF)), ["hA", "hB", "hC"])
+
+    def test_temporary_keys(self):
+        self.CONF.update({"CONFIG_NOVA_COMPUTE_HOSTS": "hA,hB"})
+        inventory = getHostInventory(self.CONF)
+        version = self.CONF.hostversion
+        # plugins set these for each host in turn while writing manifests
+        for host in ("hA", "hB"):
+            self.CONF["CONFIG_NOVA_COMPUTE_HOST"] = host
+            self.CONF["CONFIG_SWIFT_STORAGE_CURRENT"] = host
+        self.assertEqual(self.CONF.hostversion, version)
+        self.assertTrue(getHostInventory(self.CONF) is inventory)
+        self.assertEqual(HostInventory(self.CONF).getRoles("hB"), ["CONFIG_NOVA_COMPUTE_HOSTS"])
+
+    def test_parallelism(self):
+        # the answer's value isn't a host, unlike those of *_HOSTS keys
+        self.CONF.update({"CONFIG_MYSQL_HOST": "hA", "CONFIG_PARALLELISM": "10"})
+        self.assertEqual(ospluginutils.gethostlist(self.CONF), ["hA"])
+
+if __name__ == "__main__":
+    unittest.main()
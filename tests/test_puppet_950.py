@@ -0,0 +1,134 @@
+import os
+import StringIO
+import sys
+import unittest
+
+from packstack.installer import basedefs
+import packstack.installer.common_utils as utils
+from packstack.installer.setup_controller import Controller
+from packstack.modules.ospluginutils import ManifestFiles
+from packstack.plugins import puppet_950
+
+from test_base import PackstackTestCase
+
+def getManifest(name):
+    return os.path.join(basedefs.PUPPET_MANIFEST_DIR, name)
+
+class ManifestGraphTestCase(PackstackTestCase):
+    def setUp(self):
+        PackstackTestCase.setUp(self)
+        self.CONF.update({"CONFIG_MYSQL_HOST": "hA", "CONFIG_NOVA_COMPUTE_HOSTS": "hB,hC"})
+        self.controller, self.manifestfiles = puppet_950.controller, puppet_950.manifestfiles
+        puppet_950.controller = Controller()
+        puppet_950.manifestfiles = ManifestFiles()
+
+    def tearDown(self):
+        puppet_950.controller, puppet_950.manifestfiles = self.controller, self.manifestfiles
+        PackstackTestCase.tearDown(self)
+
+    def addFiles(self, *files):
+        for name, marker, requires in files:
+            puppet_950.manifestfiles.addFile(getManifest(name), marker, requires)
+
+    def getGraph(self):
+        nodes, dependencies = puppet_950.getManifestGraph()
+        names = lambda pairs: sorted([(host, os.path.basename(manifest)) for host, manifest in pairs])
+        return ([(host, os.path.basename(manifest)) for host, manifest in nodes],
+                dict([(os.path.basename(manifest), names(dependencies[(host, manifest)]))
+                      for host, manifest in nodes]))
+
+    def test_graph(self):
+        self.addFiles(("hA_prescript.pp", "pre", None),
+                      ("hB_prescript.pp", "pre", None),
+                      ("hC_prescript.pp", "pre", None),
+                      ("hA_mysql.pp", "mysql", None),
+                      ("hA_nova.pp", "novaapi", None),
+                      ("hB_nova.pp", "novacompute", ["pre", "novaapi"]),
+                      ("hC_nova.pp", "novacompute", ["pre", "novaapi"]),
+                      ("hC_swift.pp", "swift", []),
+                      ("hX_nova.pp", "novacompute", None),
+                      ("hA_postscript.pp", "post", None))
+        nodes, dependencies = self.getGraph()
+        # manifests of hosts that aren't in CONF are left out
+        self.assertEqual(nodes, [("hA", "hA_prescript.pp"), ("hB", "hB_prescript.pp"),
+                                 ("hC", "hC_prescript.pp"), ("hA", "hA_mysql.pp"),
+                                 ("hA", "hA_nova.pp"), ("hB", "hB_nova.pp"),
+                                 ("hC", "hC_nova.pp"), ("hC", "hC_swift.pp"),
+                                 ("hA", "hA_postscript.pp")])
+        prescripts = [("hA", "hA_prescript.pp"), ("hB", "hB_prescript.pp"), ("hC", "hC_prescript.pp")]
+        self.assertEqual(dependencies["hA_prescript.pp"], [])
+        self.assertEqual(dependencies["hB_prescript.pp"], [])
+        # without requires a manifest waits for every earlier phase
+        self.assertEqual(dependencies["hA_mysql.pp"], prescripts)
+        self.assertEqual(dependencies["hA_nova.pp"], sorted(prescripts + [("hA", "hA_mysql.pp")]))
+        # with requires only for those markers and its own host
+        self.assertEqual(dependencies["hB_nova.pp"], sorted(prescripts + [("hA", "hA_nova.pp")]))
+        self.assertEqual(dependencies["hC_nova.pp"], dependencies["hB_nova.pp"])
+        self.assertEqual(dependencies["hC_swift.pp"], [("hC", "hC_nova.pp"), ("hC", "hC_prescript.pp")])
+        self.assertEqual(len(dependencies["hA_postscript.pp"]), 8)
+
+    def test_order(self):
+        self.addFiles(("hA_a.pp", "a", None),
+                      ("hB_b.pp", "b", []),
+                      ("hC_c.pp", "c", ["a"]),
+                      ("hB_d.pp", "a", ["c"]),
+                      ("hA_e.pp", "e", None))
+        nodes, dependencies = puppet_950.getManifestGraph()
+        # every manifest only waits for manifests that come before it
+        for position, node in enumerate(nodes):
+            self.assertTrue(dependencies[node] <= set(nodes[:position]))
+        self.assertEqual(dependencies[nodes[3]], set([nodes[1], nodes[2]]))
+        self.assertEqual(dependencies[nodes[4]], set(nodes[:4]))
+
+class PuppetRunsTestCase(PackstackTestCase):
+    """
+    Applies manifests with a stand-in for puppet that only writes a few
+    lines to its log
+    """
+    def setUp(self):
+        PackstackTestCase.setUp(self)
+        bindir = os.path.join(self.tempdir, "bin")
+        os.makedirs(bindir)
+        with open(os.path.join(bindir, "puppet"), "w") as fp:
+            fp.write("#!/bin/sh\nfor arg; do :; done\necho \"Notice: applying $(basename $arg)\"\n"
+                     "printf \"Notice: Finished catalog run in 0.01 seconds\"\nexit 2\n")
+        os.chmod(os.path.join(bindir, "puppet"), 0755)
+        self.path, self.parallelism, self.stdout = os.environ["PATH"], utils.HostPool.parallelism, sys.stdout
+        os.environ["PATH"] = "%s:%s" % (bindir, self.path)
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        os.environ["PATH"], utils.HostPool.parallelism, sys.stdout = self.path, self.parallelism, self.stdout
+        PackstackTestCase.tearDown(self)
+
+    def applyAll(self, runs, nodes):
+        for hostname, name in nodes:
+            open(getManifest(name), "w").close()
+            runs.apply(hostname, getManifest(name))
+        finished = []
+        while not runs.isEmpty():
+            finished += runs.wait()[0]
+        return sorted([(hostname, os.path.basename(manifest)) for hostname, manifest in finished])
+
+    def test_limit(self):
+        utils.HostPool.parallelism = 2
+        runs = puppet_950.PuppetRuns()
+        try:
+            self.assertEqual(runs.loop.limit, 2)
+            nodes = [("h%d" % i, "h%d_nova.pp" % i) for i in range(5)]
+            # runs past the limit wait for a slot instead of all starting at once
+            self.assertEqual(self.applyAll(runs, nodes), nodes)
+            self.assertEqual(runs.failed, [])
+        finally:
+            runs.close()
+        # the logs are closed as soon as their run is done, and the copy
+        # matches the host's log byte for byte
+        self.assertEqual(runs.openlogs, {})
+        with open(os.path.join(runs.logdir, "h3_nova.pp.log")) as fp:
+            with open(getManifest("h3_nova.pp.log")) as hostlog:
+                self.assertEqual(fp.read(), hostlog.read())
+        self.assertEqual(runs.offsets["h3", getManifest("h3_nova.pp")],
+                         os.path.getsize(getManifest("h3_nova.pp.log")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from packstack.installer.setup_controller import ConfDict
+
+class ConfDictTestCase(unittest.TestCase):
+    def test_hostversion(self):
+        conf = ConfDict({"CONFIG_MYSQL_HOST": "hA"})
+        version = conf.hostversion
+        conf["CONFIG_MYSQL_PW"] = "secret"
+        conf.update(CONFIG_MYSQL_USER="root")
+        conf["CONFIG_MYSQL_HOST"] = "hA"
+        self.assertEqual(conf.hostversion, version)
+        conf["CONFIG_MYSQL_HOST"] = "hB"
+        self.assertTrue(conf.hostversion > version)
+        for change in (lambda: conf.update({"CONFIG_NOVA_COMPUTE_HOSTS": "hC"}),
+                       lambda: conf.setdefault("CONFIG_SWIFT_PROXY_HOSTS", "hD"),
+                       lambda: conf.pop("CONFIG_SWIFT_PROXY_HOSTS"),
+                       lambda: conf.__delitem__("CONFIG_NOVA_COMPUTE_HOSTS"),
+                       conf.clear):
+            version = conf.hostversion
+            change()
+            self.assertTrue(conf.hostversion > version)
+        self.assertEqual(conf, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import subprocess
+import time
+import unittest
+
+from packstack.installer import basedefs, transports
+import packstack.installer.common_utils as utils
+
+from test_base import PackstackTestCase
+
+def run(transport, host, command):
+    proc = subprocess.Popen(transport.getArgs(host, command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdoutdata, stderrdata = proc.communicate()
+    return proc.returncode, stdoutdata
+
+class TransportTestCase(PackstackTestCase):
+    def setUp(self):
+        PackstackTestCase.setUp(self)
+        self.environ = dict(os.environ)
+        for name in os.environ.keys():
+            if name.startswith("PACKSTACK_"):
+                del os.environ[name]
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        PackstackTestCase.tearDown(self)
+
+    def test_getTransport(self):
+        self.assertTrue(isinstance(transports.getTransport("ssh"), transports.SshTransport))
+        self.assertRaises(Exception, transports.getTransport, "carrier-pigeon")
+        os.environ["PACKSTACK_TRANSPORT"] = "local"
+        self.assertTrue(isinstance(transports.getTransport("ssh"), transports.LocalTransport))
+
+    def test_ssh_masters(self):
+        commands = []
+        def call(cmd, **kwargs):
+            commands.append(cmd)
+            # give the other hosts' masters time to start opening
+            time.sleep(0.1)
+            return 0
+        transport = transports.SshTransport()
+        call, subprocess.call = subprocess.call, call
+        try:
+            hosts = ["h%d" % i for i in range(5)]
+            utils.HostPool(hosts, parallelism=5).run(transport.connect).raiseOnError()
+            # each host has a control socket of its own
+            paths = [transport.getControlPath(host) for host in hosts]
+            self.assertEqual(len(set(paths)), 5)
+            self.assertEqual(len(commands), 5)
+            args = transport.getArgs("h3", "true")
+            self.assertTrue("ControlPath=%s" % paths[3] in args)
+            self.assertEqual(args[-2:], ["root@h3", "true"])
+            transport.closeAll()
+            self.assertEqual(transport.masters, {})
+        finally:
+            subprocess.call = call
+
+    def test_local(self):
+        self.assertEqual(transports.Transport().getArgs("hA", "true"), ["bash", "-c", "true"])
+        transport = transports.LocalTransport()
+        self.assertEqual(run(transport, "hA", "echo 'it''s' $((1 + 2)); exit 3"), (3, "its 3\n"))
+        self.assertEqual(transport.getCommand("hA", "echo a b"), "bash -c 'echo a b'")
+
+    def test_simulated(self):
+        os.environ["PACKSTACK_SIM_ROOT"] = os.path.join(self.tempdir, "sim")
+        stubs = os.path.join(self.tempdir, "stubs")
+        os.mkdir(stubs)
+        with open(os.path.join(stubs, "yum"), "w") as fp:
+            fp.write("#!/bin/sh\necho stub yum $PACKSTACK_SIM_HOST \"$@\"\n")
+        os.chmod(os.path.join(stubs, "yum"), 0755)
+        os.environ["PACKSTACK_SIM_STUBS"] = stubs
+        transport = transports.SimulatedTransport()
+
+        # each host has a sandbox of its own to run in
+        self.assertEqual(run(transport, "hA", "touch file; echo $HOME; pwd"),
+                         (0, "%s\n%s\n" % (transport.getSandbox("hA"), transport.getSandbox("hA"))))
+        self.assertEqual(transport.getSandbox("hA"), os.path.join(self.tempdir, "sim", "hA"))
+        self.assertTrue(os.path.exists(os.path.join(transport.getSandbox("hA"), "file")))
+        self.assertFalse(os.path.exists(os.path.join(transport.getSandbox("hB"), "file")))
+        self.assertEqual(run(transport, "hB", "yum install -y puppet"), (0, "stub yum hB install -y puppet\n"))
+        # a root given in the environment is left in place
+        transport.closeAll()
+        self.assertTrue(os.path.isdir(os.path.join(self.tempdir, "sim", "hA")))
+
+    def test_simulated_paths(self):
+        os.environ["PACKSTACK_SIM_ROOT"] = os.path.join(self.tempdir, "sim")
+        os.environ["PACKSTACK_SIM_PATHS"] = "/etc/packstack-test"
+        transport = transports.SimulatedTransport()
+        command = "mkdir -p %s/manifests /etc/packstack-test && touch %s/manifests/f /etc/packstack-test/f" % (
+            basedefs.VAR_DIR, basedefs.VAR_DIR)
+        self.assertEqual(run(transport, "hA", command)[0], 0)
+        # the installer's paths are the host's own
+        sandbox = transport.getSandbox("hA")
+        self.assertTrue(os.path.exists(sandbox + basedefs.VAR_DIR + "/manifests/f"))
+        self.assertTrue(os.path.exists(sandbox + "/etc/packstack-test/f"))
+        self.assertFalse(os.path.exists(os.path.join(basedefs.VAR_DIR, "manifests", "f")))
+        self.assertFalse(os.path.exists("/etc/packstack-test"))
+        # other paths, longer names and paths already rooted are left alone
+        self.assertEqual(transport.rootPaths("hA", "ls %s-old /etc %s" % (basedefs.VAR_DIR, sandbox + basedefs.VAR_DIR)),
+                         "ls %s-old /etc %s" % (basedefs.VAR_DIR, sandbox + basedefs.VAR_DIR))
+        relay = transport.getRelayCommand("hA", "hB", "cat > %s/m.tar.gz" % basedefs.REMOTE_MODULE_CACHE_DIR)
+        command = transport.rootPaths("hA", "%s < %s/m.tar.gz" % (relay, basedefs.REMOTE_MODULE_CACHE_DIR))
+        self.assertEqual(command.count(transport.getSandbox("hB") + basedefs.REMOTE_MODULE_CACHE_DIR), 1)
+        self.assertEqual(command.count(sandbox + basedefs.REMOTE_MODULE_CACHE_DIR), 1)
+
+    def test_simulated_failures(self):
+        os.environ["PACKSTACK_SIM_FAILURE_RATE"] = "1"
+        transport = transports.SimulatedTransport()
+        self.assertEqual(run(transport, "hA", "echo hello")[0], 255)
+        root = transport.root
+        self.assertTrue(os.path.isdir(root))
+        transport.closeAll()
+        self.assertFalse(os.path.exists(root))
+
+if __name__ == "__main__":
+    unittest.main()